@@ -1,8 +1,16 @@
-from openpyxl import load_workbook
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, Alignment
+from openpyxl.utils import get_column_letter, range_boundaries
 from openpyxl.worksheet.table import Table, TableStyleInfo
-import os
+from copy import copy
+import os, warnings
 import pandas as pd
+from table_io import read_xlsx_cells, prefetch
+from cantabular_metadata import get_cantabular_metadata
+from build_manifest import BuildManifest, code_version
+from stage_profile import StageProfile
+import table_io, cantabular_metadata
 
 # move files into self.location_of_final_files to run AccessibleData class object
 
@@ -14,157 +22,223 @@ class AccessibleData:
         
         self.cantabular_files_path = ""
         self.commission_tables_metadata = ""
+        self.metadata_snapshot = "sp-data/metadata-snapshot.pickle"
         
         self.font_size = 12
-
+        self.incremental = True # files already styled by this code & metadata are not styled again
+        self.profile_report = None # e.g. "sp-data/accessible-profile.json" - writes time & memory of each file at the end of a run
+        self.prefetch_workbooks = 0 # workbooks read ahead in background threads while the current one is written - reading a workbook is python code holding the GIL so this rarely overlaps, 0 reads each when it is reached
+        
+        self.commission_titles = None
+        self.dataset_titles = {}
+        self.profile = StageProfile('accessible')
         
     def run(self):
+        with self.profile.phase('metadata'):
+            self._load_dataset_titles()
+        manifest = BuildManifest(
+                f"{self.location_of_final_files}/.manifest.json", 
+                code_version(__file__, table_io.__file__, cantabular_metadata.__file__), 
+                self.metadata.version
+                )
+        self.unchanged = []
+        files_to_style = []
         for file in self.files:
-            self.accessible_data(file)
-            self.accessible_metadata(file)
+            file_path = f"{self.location_of_final_files}/{file}"
+            if self.incremental and manifest.is_current(file_path, []):
+                self.unchanged.append(file)
+                continue
+            files_to_style.append(file)
+            
+        # each workbook only reads & writes its own file, so the next ones can be read while one is written
+        for file, sheets in prefetch(files_to_style, self._read_cells, self.prefetch_workbooks):
+            with self.profile.phase('accessible_formatting', file.split('.')[0]):
+                self.accessible_workbook(file, sheets.result())
+            manifest.record(f"{self.location_of_final_files}/{file}", [])
+            
+        manifest.save()
+        if self.unchanged != []:
+            print(f"{len(self.unchanged)} files already accessible and skipped")
+        self.profile.save(self.profile_report)
+        return
     
-    def accessible_metadata(self, file):
+    def accessible_workbook(self, file, sheets=None):
+        # reads the cell values of both sheets and writes the workbook again with the accessible layout
+        # sheets - the cell values already read by _read_cells, the file is read if not given
         dataset_id = file.split('.')[0]
-        # load data
-        book = load_workbook(f"{self.location_of_final_files}/{file}")
-        ws = book["Metadata"]
+        file_path = f"{self.location_of_final_files}/{file}"
+        if sheets is None:
+            sheets = self._read_cells(file)
         
-        # determine column sizes
-        # using preset values
-        ws.column_dimensions['A'].width = 44
-        ws.column_dimensions['B'].width = 83
+        data_rows = sheets["Data"]
+        data_df = pd.DataFrame(data_rows[1:], columns=data_rows[0], dtype=object)
         
-        # change font size for all
-        text_font = Font(size=self.font_size)
-        url_font = Font(underline='single', color='000000FF', size=self.font_size)
-        for row in ws.iter_rows():
-            for cell in row:
-                cell.font = text_font
-                
-        for cell in ws['B']:
-            try:
-                if cell.value.startswith("=HYPER"):
-                    cell.font = url_font
-            except:
-                pass
-        
-        # move data 2 rows down
-        table_position = ws.dimensions
-        ws.move_range(table_position, rows=2)
-        
-        # add title in cell A1
-        dataset_title = self._get_dataset_title(dataset_id)
-        ws['A1'] = f"Metadata for {dataset_title}"
-        ws['A1'].style = 'Headline 1'
-        
-        # add value in A2
-        ws['A2'] = "This worksheet contains one table of metadata."
-        ws['A2'].font = text_font
-        
-        # table dimensions for table and wrapping text
-        table_dimensions = ws.dimensions
-        table_dimensions = table_dimensions.replace('A1', 'A3')
-        
-        # wrap text
-        for row in ws[table_dimensions]:
-            for cell in row:
-                cell.alignment = Alignment(wrap_text=True)
-        
-        # create table
-        table = Table(displayName="Metadata", ref=table_dimensions)
-        table_style = TableStyleInfo(
-            name='TableStyleLight1', showFirstColumn=False, 
-            showLastColumn=False, showRowStripes=True, showColumnStripes=False
-            )
-        table.tableStyleInfo = table_style
-        ws.add_table(table)
-                
-        book.save(f"{self.location_of_final_files}/{file}")
+        self.write_accessible_workbook(file_path, dataset_id, data_df, sheets["Metadata"])
         
         return
     
+    def _read_cells(self, file):
+        return read_xlsx_cells(f"{self.location_of_final_files}/{file}")
     
-    def accessible_data(self, file):
-        dataset_id = file.split('.')[0]
-        # load data
-        book = load_workbook(f"{self.location_of_final_files}/{file}")
-        ws = book["Data"]
-        
-        # determine column sizes
-        for column in ws.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(cell.value)
-                except:
-                    pass
-            ws.column_dimensions[column_letter].width = max_length + 2
-        
-        # change font size for all
+    def write_accessible_workbook(self, file, dataset_id, data_df, metadata_rows):
+        # writes the Data & Metadata sheets with the accessible layout in a single pass over the cells
+        # each sheet has a title & description above its values, which are in a table named after the sheet
+        # data_df - values of the Data sheet with empty cells as None (see table_io.sheet_values), its columns are the header row
+        # metadata_rows - rows of values of the Metadata sheet, empty cells as None
+        book = Workbook(write_only=True)
+        
+        data_sheet = book.create_sheet("Data")
+        for position, width in enumerate(_column_widths(data_df)):
+            data_sheet.column_dimensions[get_column_letter(position + 1)].width = width
+        data_rows = [list(data_df.columns)] + list(data_df.itertuples(index=False, name=None))
+        self._write_accessible_sheet(
+            data_sheet, "Data", f"Data for {self._get_dataset_title(dataset_id)}", 
+            "This worksheet contains one table.", data_rows, len(data_df.columns)
+            )
+        
+        # empty cells past the last value are not part of the metadata table
+        # column B always is
+        metadata_sheet = book.create_sheet("Metadata")
+        metadata_sheet.column_dimensions['A'].width = 44
+        metadata_sheet.column_dimensions['B'].width = 83
+        metadata_rows = [row for row in metadata_rows]
+        while metadata_rows and all(value is None for value in metadata_rows[-1]):
+            metadata_rows.pop()
+        used_columns = [position + 1 for row in metadata_rows for position, value in enumerate(row) if value is not None]
+        self._write_accessible_sheet(
+            metadata_sheet, "Metadata", f"Metadata for {self._get_dataset_title(dataset_id)}", 
+            "This worksheet contains one table of metadata.", metadata_rows, max(used_columns, default=1), 
+            url_column=2, minimum_columns=2
+            )
+        
+        book.save(file)
+        return
+    
+    def _write_accessible_sheet(self, ws, table_name, title, description, rows, number_of_columns, url_column=None, minimum_columns=1):
+        # title & description in A1 & A2, the table from A3 with every cell in text_font and wrapped
+        # cells in url_column starting "=HYPER" are in url_font
+        # the table runs from A3 to the last column & row written, and always takes in at least minimum_columns
         text_font = Font(size=self.font_size)
-        for row in ws.iter_rows():
-            for cell in row:
-                cell.font = text_font
-        
-        # move data 2 rows down
-        table_position = ws.dimensions
-        ws.move_range(table_position, rows=2)
-        
-        # add title in cell A1
-        dataset_title = self._get_dataset_title(dataset_id)
-        ws['A1'] = f"Data for {dataset_title}"
-        ws['A1'].style = 'Headline 1'
-        
-        # add value in A2
-        ws['A2'] = "This worksheet contains one table."
-        ws['A2'].font = text_font
-        
-        # table dimensions for table and wrapping text
-        table_dimensions = ws.dimensions
-        table_dimensions = table_dimensions.replace('A1', 'A3')
-        
-        # wrap text
-        for row in ws[table_dimensions]:
-            for cell in row:
-                cell.alignment = Alignment(wrap_text=True)
-        
-        # create table
-        table = Table(displayName="Data", ref=table_dimensions)
+        url_font = Font(underline='single', color='000000FF', size=self.font_size)
+        wrap = Alignment(wrap_text=True)
+        
+        number_of_rows = len(rows)
+        last_column = get_column_letter(max(number_of_columns, minimum_columns, 1))
+        table_dimensions = f"A1:{last_column}{max(number_of_rows, 1) + 2}".replace('A1', 'A3')
+        min_col, min_row, max_col, max_row = range_boundaries(table_dimensions)
+        
+        # one styled cell of each kind, copied for every cell written
+        styles = {}
+        for in_data, in_table, is_url in ((True, True, False), (True, False, False), (False, True, False), (True, True, True), (True, False, True)):
+            cell = WriteOnlyCell(ws)
+            if in_data:
+                cell.font = url_font if is_url else text_font
+            if in_table:
+                cell.alignment = wrap
+            styles[(in_data, in_table, is_url)] = cell._style
+            
+        title_cell = WriteOnlyCell(ws, title)
+        title_cell.style = 'Headline 1'
+        ws.append([title_cell])
+        description_cell = WriteOnlyCell(ws, description)
+        description_cell.font = text_font
+        ws.append([description_cell])
+        
+        for row_number in range(3, max(number_of_rows + 2, max_row) + 1):
+            values = rows[row_number - 3] if row_number - 3 < number_of_rows else ()
+            in_table_row = min_row <= row_number <= max_row
+            cells = []
+            for column_number in range(1, max(number_of_columns, max_col if in_table_row else 0) + 1):
+                in_data = column_number <= number_of_columns and row_number - 3 < number_of_rows
+                in_table = in_table_row and min_col <= column_number <= max_col
+                if not in_data and not in_table:
+                    cells.append(None)
+                    continue
+                value = values[column_number - 1] if in_data else None
+                is_url = in_data and column_number == url_column and isinstance(value, str) and value.startswith("=HYPER")
+                cell = WriteOnlyCell(ws, value)
+                cell._style = copy(styles[(in_data, in_table, is_url)])
+                cells.append(cell)
+            ws.append(cells)
+            
+        table = Table(displayName=table_name, ref=table_dimensions)
         table_style = TableStyleInfo(
             name='TableStyleLight1', showFirstColumn=False, 
             showLastColumn=False, showRowStripes=True, showColumnStripes=False
             )
         table.tableStyleInfo = table_style
-        ws.add_table(table)
-                
-        book.save(f"{self.location_of_final_files}/{file}")
+        
+        # a write-only sheet cannot read the column headings back, so they are named here as openpyxl names them on save
+        header = list(rows[0]) if rows and min_row == 3 else []
+        table._initialise_columns()
+        for position, column in enumerate(table.tableColumns):
+            column.name = str(header[position] if position < len(header) else None)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            ws.add_table(table)
         
         return
     
     def _get_dataset_title(self, dataset_id):
-        dataset_df = pd.read_csv(f"{self.cantabular_files_path}/Dataset.csv")
-        commission_metadata_df = pd.read_excel(f"{self.commission_tables_metadata}", sheet_name="EILR")
+        # titles are resolved once per dataset_id from lookups built once per run
+        if self.commission_titles is None:
+            self._load_dataset_titles()
+            
+        if dataset_id in self.dataset_titles:
+            return self.dataset_titles[dataset_id]
         
-
-        if dataset_id.startswith("SP2") and dataset_id.endswith('H') or dataset_id.startswith("SP2") and dataset_id.endswith('G') or dataset_id in ("SP115A", "SP116A", "SP117A", "SP118A", "SP119A"):
-            df_loop = commission_metadata_df[commission_metadata_df[' table number'] == dataset_id]
+        if self._title_from_commission_tables(dataset_id):
+            if dataset_id not in self.commission_titles:
+                raise Exception(f"{dataset_id} not found in commissioned tables spec")
             
-            dataset_title = df_loop['table title'].iloc[0]
+            dataset_title = self.commission_titles[dataset_id]
             
         elif dataset_id.startswith("SP1") or dataset_id.startswith("SP2"):
-            df_loop = dataset_df[dataset_df['Dataset_Mnemonic'] == dataset_id]
-            
-            if len(df_loop) == 0:
-                df_loop = dataset_df[dataset_df['Dataset_Mnemonic'] == dataset_id[:-1]]
-                if len(df_loop) == 0:
-                    raise Exception("df_loop still has length 0..")
-            
-            dataset_title = df_loop['Dataset_Title'].iloc[0] 
+            if self.metadata.has_dataset(dataset_id):
+                dataset_title = self.metadata.dataset(dataset_id)['title']
+            elif self.metadata.has_dataset(dataset_id[:-1]):
+                dataset_title = self.metadata.dataset(dataset_id[:-1])['title']
+            else:
+                raise Exception(f"{dataset_id} not found in Dataset.csv")
             
         else:
             raise TypeError(f"{dataset_id} should start SP1 or SP2")
-            
+        
+        self.dataset_titles[dataset_id] = dataset_title
         return dataset_title
+    
+    def _load_dataset_titles(self):
+        # builds the title lookup for tables whose title comes from the commissioned tables spec
+        self.metadata = get_cantabular_metadata(self.cantabular_files_path, self.commission_tables_metadata, self.metadata_snapshot)
+        
+        self.commission_titles = {}
+        for dataset_id in self.metadata.commission_tables:
+            if self._title_from_commission_tables(dataset_id):
+                self.commission_titles[dataset_id] = self.metadata.commission_table(dataset_id)['title']
+                
+        self.dataset_titles = {}
+        return
+    
+    def _title_from_commission_tables(self, dataset_id):
+        # SP2 H & G tables and SP115A-SP119A are not in Dataset.csv
+        if dataset_id.startswith("SP2") and (dataset_id.endswith('H') or dataset_id.endswith('G')):
+            return True
+        return dataset_id in ("SP115A", "SP116A", "SP117A", "SP118A", "SP119A")
+
 
+def _column_widths(df):
+    # width of each column of the Data sheet - the length of its longest text, header included, + 2
+    # values that are not text are not counted
+    widths = []
+    for position, header in enumerate(df.columns):
+        column = df.iloc[:, position].astype(object)
+        max_length = len(header) if isinstance(header, str) else 0
+        try:
+            longest = column.str.len().max()
+        except AttributeError:
+            # no text in the column
+            longest = None
+        if pd.notna(longest) and longest > max_length:
+            max_length = int(longest)
+        widths.append(max_length + 2)
+    return widths
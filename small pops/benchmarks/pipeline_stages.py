@@ -0,0 +1,325 @@
+import os, sys, time, shutil, resource, tempfile, argparse, contextlib
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+code_location = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, code_location)
+
+# times the entry point of every stage on synthetic data - cantabular metadata csvs, a commissioned tables spec,
+# commission table source workbooks in the layout the create_new_transform template reads & outputs csvs
+# python benchmarks/pipeline_stages.py [--datasets 5] [--geographies 500] [--categories 10] [--keep folder]
+#
+# each dataset gives outputs tables nat/ltla/msoa_SPxxx, a commission table SPxxxA combined with them
+# and a commission table SP2xxH that is not combined
+# stages run one after another in a fresh process each, so peak memory is that stage's own high-water mark
+# (worker processes started by a stage are not included), stage output & warnings go to <stage>.log in the work folder
+# no network access is needed, everything is generated locally
+
+stages = ['metadata', 'ct', 'outputs', 'final', 'accessible', 'pipeline']
+
+cantabular_folder = "cantabular"
+commission_tables_metadata = "sp-data/commissioned tables small pops spec 09062023.xlsx"
+metadata_snapshot = "sp-data/metadata-snapshot.pickle"
+ct_start_row = 2 # header row of a commission table tab, the data starts on the row below
+
+
+def letters(number):
+    # 0 -> 'a', 26 -> 'ba', variable mnemonics have no digits so they are not read as classifications
+    name = ''
+    while True:
+        name = chr(ord('a') + number % 26) + name
+        number //= 26
+        if number == 0:
+            return name
+
+
+def synthetic_sizes(number_of_datasets, number_of_geographies, number_of_categories):
+    return {
+            'datasets': number_of_datasets,
+            'msoa': number_of_geographies,
+            'ltla': max(number_of_geographies // 10, 1),
+            'nat': 1,
+            'categories': number_of_categories
+            }
+
+
+def dataset_ids(sizes):
+    # (outputs dataset, combined commission table, commission table not combined)
+    return [(f"SP1{i + 1:02d}", f"SP1{i + 1:02d}A", f"SP2{i + 1:02d}H") for i in range(sizes['datasets'])]
+
+
+def geographies(area, number):
+    prefix = {'nat': 'K04', 'ltla': 'E06', 'msoa': 'E02'}[area]
+    return [(f"{prefix}{i + 1:06d}", f"{area.upper()} place {i + 1}") for i in range(number)]
+
+
+def write_synthetic_data(folder, sizes):
+    # returns rows written for each stage to read
+    for location in ('sp-data/ct', 'sp-data/outputs', 'sp-data/accessible-test', 'census-transforms',
+                     'census-outputs/ct', 'census-outputs/outputs', 'census-outputs/final', cantabular_folder):
+        os.makedirs(f"{folder}/{location}", exist_ok=True)
+    # sp_data_tidy writes to census-test-outputs/outputs, final_transforms reads from census-outputs/outputs
+    os.symlink('census-outputs', f"{folder}/census-test-outputs")
+
+    rng = np.random.default_rng(0)
+    categories = [f"Category {code}" for code in range(1, sizes['categories'] + 1)]
+
+    _write_cantabular_files(f"{folder}/{cantabular_folder}", sizes, categories)
+    _write_commission_tables_metadata(f"{folder}/{commission_tables_metadata}", sizes)
+
+    rows = {'ct': 0, 'outputs': 0}
+    for i, (outputs_dataset, combined_dataset, dataset) in enumerate(dataset_ids(sizes)):
+        classification_label = f"Variable {letters(i).upper()} ({sizes['categories']} categories)"
+        for area in ('nat', 'ltla', 'msoa'):
+            rows['outputs'] += _write_outputs_csv(f"{folder}/sp-data/outputs/{area}_{outputs_dataset}.csv", area, sizes[area], classification_label, categories, rng)
+
+        rows['ct'] += _write_ct_source(f"{folder}/sp-data/ct/{combined_dataset}_source.xlsx", ['msoa'], sizes, categories, rng)
+        rows['ct'] += _write_ct_source(f"{folder}/sp-data/ct/{dataset}_source.xlsx", ['nat', 'msoa'], sizes, categories, rng)
+
+    rows['final'] = rows['ct'] + rows['outputs']
+    rows['accessible'] = rows['final']
+    rows['pipeline'] = rows['final']
+    return rows
+
+
+def _write_cantabular_files(folder, sizes, categories):
+    variables = [f"var{letters(i)}" for i in range(sizes['datasets'])]
+    titles = [f"Variable {letters(i).upper()}" for i in range(sizes['datasets'])]
+    outputs_datasets = [outputs_dataset for outputs_dataset, combined_dataset, dataset in dataset_ids(sizes)]
+
+    pd.DataFrame({
+            'Variable_Mnemonic': ['nat', 'ltla', 'msoa'] + variables,
+            'Variable_Type_Code': ['GEOG'] * 3 + ['DVO'] * len(variables),
+            'Variable_Title': ['England and Wales', 'Lower tier local authorities', 'Middle layer Super Output Areas'] + titles,
+            'Variable_Description': [f"Description of {variable}" for variable in ['nat', 'ltla', 'msoa'] + variables],
+            'Quality_Statement_Text': [None] * 3 + [f"Quality of {variable}" for variable in variables],
+            'Quality_Summary_URL': [None] * 3 + [f"https://example.com/quality/{variable}" for variable in variables],
+            'Topic_Mnemonic': ['GEO'] * 3 + ['DEM'] * len(variables)
+            }).to_csv(f"{folder}/Variable.csv", index=False)
+
+    pd.DataFrame({
+            'Dataset_Mnemonic': outputs_datasets,
+            'Dataset_Title': [f"Synthetic dataset {dataset}" for dataset in outputs_datasets],
+            'Dataset_Description': [f"Description of {dataset}" for dataset in outputs_datasets],
+            'Statistical_Unit': 'Person',
+            'Dataset_Population': 'All usual residents'
+            }).to_csv(f"{folder}/Dataset.csv", index=False)
+
+    dataset_variables = []
+    for dataset, variable in zip(outputs_datasets, variables):
+        dataset_variables.append([dataset, 'msoa', 'msoa', 'Y'])
+        dataset_variables.append([dataset, variable, f"{variable}_{sizes['categories']}", None])
+    pd.DataFrame(dataset_variables, columns=['Dataset_Mnemonic', 'Variable_Mnemonic', 'Classification_Mnemonic', 'Lowest_Geog_Variable_Flag']).to_csv(f"{folder}/Dataset_Variable.csv", index=False)
+
+    pd.DataFrame({
+            'Classification_Mnemonic': [f"{variable}_{sizes['categories']}" for variable in variables],
+            'External_Classification_Label_English': [f"{title} ({sizes['categories']} categories)" for title in titles]
+            }).to_csv(f"{folder}/Classification.csv", index=False)
+
+    pd.DataFrame(
+            [[f"{variable}_{sizes['categories']}", label, code] for variable in variables for code, label in enumerate(categories, 1)],
+            columns=['Classification_Mnemonic', 'External_Category_Label_English', 'Category_Code']
+            ).to_csv(f"{folder}/Category.csv", index=False)
+
+    pd.DataFrame({'SDC_Statement': ['Synthetic data, no disclosure control applied']}).to_csv(f"{folder}/Source.csv", index=False)
+    return
+
+
+def _write_commission_tables_metadata(file, sizes):
+    eilr = []
+    for i, (outputs_dataset, combined_dataset, dataset) in enumerate(dataset_ids(sizes)):
+        classification = f"var{letters(i)}_{sizes['categories']}"
+        eilr.append([combined_dataset, f"Synthetic table {combined_dataset}", f"Notes for {combined_dataset}", classification, 'MSOA', 'All usual residents: synthetic'])
+        eilr.append([dataset, f"Synthetic table {dataset}", f"Notes for {dataset}", classification, 'National/MSOA', 'All usual residents: synthetic'])
+    # the population of every SPxxxH table is taken from SP219H
+    if 'SP219H' not in [row[0] for row in eilr]:
+        eilr.append(['SP219H', "Synthetic table SP219H", "Notes for SP219H", f"vara_{sizes['categories']}", 'National', 'All usual residents: synthetic'])
+    columns = [' table number', 'table title', 'dataset_description / Table Notes', 'variables', 'Geography', 'table population']
+
+    with pd.ExcelWriter(file) as writer:
+        pd.DataFrame(eilr, columns=columns).to_excel(writer, sheet_name='EILR', index=False)
+        pd.DataFrame([], columns=columns).to_excel(writer, sheet_name='COB', index=False)
+    return
+
+
+def _write_outputs_csv(file, area, number_of_geographies, classification_label, categories, rng):
+    codes = np.tile(np.arange(1, len(categories) + 1), number_of_geographies)
+    geography = np.repeat(np.array(geographies(area, number_of_geographies)), len(categories), axis=0)
+    pd.DataFrame({
+            f"{area} Code": geography[:, 0],
+            f"{area} name": geography[:, 1],
+            f"{classification_label} Code": codes,
+            f"{classification_label} Label": [categories[code - 1] for code in codes],
+            'Count': rng.integers(0, 1000, len(codes)),
+            'Percentage': np.round(rng.random(len(codes)) * 100, 1)
+            }).to_csv(file, index=False)
+    return len(codes)
+
+
+def _write_ct_source(file, areas, sizes, categories, rng):
+    # a tab per area type - a block per small population with its name in column A on the first row,
+    # category labels in column B & observations in column C, then a "Created on" footer
+    tab_names = {'nat': 'Table National', 'msoa': 'Table MSOA', 'ltla': 'Table LTLA'}
+    book = Workbook(write_only=True)
+    rows = 0
+    for area in areas:
+        ws = book.create_sheet(tab_names[area])
+        ws.append([f"Synthetic commission table - {tab_names[area]}"])
+        ws.append(['Small population', 'Category', 'Count'])
+        for code, label in geographies(area, sizes[area]):
+            observations = rng.integers(0, 1000, len(categories))
+            for i, category in enumerate(categories):
+                ws.append([f"{code} {label}" if i == 0 else None, category, int(observations[i])])
+            rows += len(categories)
+        ws.append(["Created on 1 January 2023"])
+    book.save(file)
+    return rows
+
+
+def write_transforms(folder, sizes):
+    # scripts from the create_new_transform template with the file, obs column, start row & dimension filled in
+    os.chdir(folder)
+    _use_synthetic_metadata(folder)
+    from ct_tables_transform import run_transforms_commission_tables
+    ct = run_transforms_commission_tables()
+
+    for i, (outputs_dataset, combined_dataset, dataset) in enumerate(dataset_ids(sizes)):
+        for dataset_id in (combined_dataset, dataset):
+            ct.create_new_transform(dataset_id)
+            transform_file = f"census-transforms/{dataset_id}.py"
+            with open(transform_file) as f:
+                script = f.read()
+
+            script = script.replace('#file = f"{source_location}/{dataset_code}_.xlsx"', 'file = f"{source_location}/{dataset_code}_source.xlsx"')
+            script = script.replace("#obs_column = 'D'", "obs_column = 'C'")
+            script = script.replace("#start_point_row_number = '10'", f"start_point_row_number = '{ct_start_row}'")
+            script = script.replace("#('B', 'dimension1 label', CLOSEST_ABOVE),", f"('B', 'var{letters(i)}', DIRECTLY_LEFT),")
+            with open(transform_file, 'w') as f:
+                f.write(script)
+    return
+
+
+def _use_synthetic_metadata(folder):
+    # the stages are configured with cantabular_files_path = "", the catalog they ask for is loaded
+    # from the synthetic files (through the usual snapshot) before they are created
+    import cantabular_metadata
+    key = ("", commission_tables_metadata)
+    if key not in cantabular_metadata._catalogs:
+        cantabular_metadata._catalogs[key] = cantabular_metadata.load_metadata_snapshot(
+                f"{folder}/{cantabular_folder}", commission_tables_metadata, metadata_snapshot
+                )
+    return
+
+
+def run_stage(stage, folder):
+    # runs in a fresh process, returns (seconds, peak memory in MB)
+    os.chdir(folder)
+    with open(f"{stage}.log", 'w') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        if stage == 'metadata':
+            if os.path.exists(metadata_snapshot):
+                os.remove(metadata_snapshot)
+            start = time.perf_counter()
+            _use_synthetic_metadata(folder)
+            taken = time.perf_counter() - start
+
+        else:
+            _use_synthetic_metadata(folder)
+            start = time.perf_counter()
+            _stage_entry_point(stage)
+            taken = time.perf_counter() - start
+
+    return taken, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _stage_entry_point(stage):
+    if stage == 'ct':
+        from ct_tables_transform import run_transforms_commission_tables
+        run_transforms_commission_tables(transforms_to_run=['*']).run()
+
+    elif stage == 'outputs':
+        from sp_data_tidy import run_outputs
+        run_outputs().run()
+
+    elif stage == 'final':
+        from final_transforms import combine_and_add_metadata
+        combine_and_add_metadata().run()
+
+    elif stage == 'accessible':
+        from accessible_data_builder import AccessibleData
+        accessible_data = AccessibleData()
+        accessible_data.commission_tables_metadata = commission_tables_metadata
+        accessible_data.run()
+
+    elif stage == 'pipeline':
+        from run_pipeline import run_pipeline
+        run_pipeline(transforms_to_run=['*']).run()
+
+    else:
+        raise ValueError(f"stage should be one of {stages} not {stage}")
+    return
+
+
+def baseline_memory():
+    # peak memory of a fresh process that has only imported every stage, part of every stage's peak memory
+    import ct_tables_transform, sp_data_tidy, final_transforms, accessible_data_builder, run_pipeline
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(sizes, folder):
+    print(f"{sizes['datasets']} datasets, {sizes['msoa']} msoa / {sizes['ltla']} ltla geographies, {sizes['categories']} categories")
+    print(f"Writing synthetic data to {folder}")
+    source_folder = f"{folder}/stages"
+    os.makedirs(source_folder)
+    start = time.perf_counter()
+    rows = write_synthetic_data(source_folder, sizes)
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        executor.submit(write_transforms, source_folder, sizes).result()
+    print(f"Synthetic data written in {time.perf_counter() - start:.1f}s - {rows['ct']} commission table rows, {rows['outputs']} outputs table rows")
+
+    # the pipeline runs on its own copy of the data, before any stage has written anything
+    pipeline_folder = f"{folder}/pipeline"
+    shutil.copytree(source_folder, pipeline_folder, symlinks=True)
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        print(f"Memory of a process with every stage imported - {executor.submit(baseline_memory).result():.0f}MB\n")
+
+    print(f"{'stage':<12} {'time (s)':>10} {'rows':>10} {'rows/s':>12} {'peak memory (MB)':>18}")
+    for stage in stages:
+        if stage == 'accessible':
+            # AccessibleData works on copies of the final tables
+            for file in os.listdir(f"{source_folder}/census-outputs/final"):
+                if not file.startswith('.'):
+                    shutil.copyfile(f"{source_folder}/census-outputs/final/{file}", f"{source_folder}/sp-data/accessible-test/{file}")
+
+        stage_folder = pipeline_folder if stage == 'pipeline' else source_folder
+        # a new process for every stage so each has its own peak memory
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            taken, peak_memory = executor.submit(run_stage, stage, stage_folder).result()
+
+        stage_rows = rows.get(stage)
+        if stage_rows is None:
+            print(f"{stage:<12} {taken:>10.2f} {'':>10} {'':>12} {peak_memory:>18.0f}")
+        else:
+            print(f"{stage:<12} {taken:>10.2f} {stage_rows:>10} {stage_rows / taken:>12.0f} {peak_memory:>18.0f}")
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="times every stage on synthetic data")
+    parser.add_argument('--datasets', type=int, default=5, help="outputs datasets, each with two commission tables")
+    parser.add_argument('--geographies', type=int, default=500, help="msoa geographies, ltla is a tenth of this")
+    parser.add_argument('--categories', type=int, default=10, help="categories of the one dimension in each table")
+    parser.add_argument('--keep', help="folder to write to and leave in place, otherwise a temporary folder is used")
+    args = parser.parse_args()
+
+    sizes = synthetic_sizes(args.datasets, args.geographies, args.categories)
+    if args.keep:
+        run(sizes, os.path.abspath(args.keep))
+    else:
+        with tempfile.TemporaryDirectory() as folder:
+            run(sizes, folder)
@@ -0,0 +1,59 @@
+import os, sys, time, tempfile
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from table_io import write_table, read_xlsx, xlsx_readers, CalamineWorkbook
+
+# times each xlsx reader in table_io on synthetic tidy tables of different sizes
+# python benchmarks/xlsx_readers.py [rows rows ...]
+
+rows_to_test = [1000, 10000, 100000]
+repeats = 3
+
+
+def tidy_table(number_of_rows):
+    # looks like a combined tidy table - geography, area type, one dimension with code & label, count
+    rng = np.random.default_rng(0)
+    geographies = [f"E02{i:06d}" for i in range(number_of_rows // 10 + 1)]
+    codes = rng.integers(1, 11, number_of_rows)
+    geography_codes = rng.choice(geographies, number_of_rows)
+    return pd.DataFrame({
+            'Geography Code': geography_codes,
+            'Geography Label': [f"Area {code[-4:]}" for code in geography_codes],
+            'Area type': 'Middle layer Super Output Areas',
+            'Sex (2 categories) Code': codes,
+            'Sex (2 categories) Label': [f"Category {code}" for code in codes],
+            'Count': rng.integers(0, 500, number_of_rows).astype(str)
+            })
+
+
+def time_reader(file, reader):
+    best = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        read_xlsx(file, reader=reader)
+        taken = time.perf_counter() - start
+        best = taken if best is None else min(best, taken)
+    return best
+
+
+def run(rows_list):
+    readers = [reader for reader in xlsx_readers if reader != 'calamine' or CalamineWorkbook is not None]
+    print(f"{'rows':>8} {'size (KB)':>10} " + ' '.join(f"{reader + ' (s)':>15}" for reader in readers) + "  speed up vs pandas")
+    
+    with tempfile.TemporaryDirectory() as folder:
+        for number_of_rows in rows_list:
+            file = f"{folder}/table_{number_of_rows}.xlsx"
+            write_table(tidy_table(number_of_rows), file)
+            
+            timings = {reader: time_reader(file, reader) for reader in readers}
+            speed_up = ', '.join(f"{reader} x{timings['pandas'] / timings[reader]:.1f}" for reader in readers if reader != 'pandas')
+            print(f"{number_of_rows:>8} {os.path.getsize(file) / 1024:>10.0f} " + ' '.join(f"{timings[reader]:>15.3f}" for reader in readers) + f"  {speed_up}")
+    return
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        rows_to_test = [int(value) for value in sys.argv[1:]]
+    run(rows_to_test)
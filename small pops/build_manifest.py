@@ -0,0 +1,119 @@
+import os, json, hashlib
+
+# records, for every artifact a stage writes, the inputs it was built from (size, mtime & hash of each file)
+# along with the metadata and code versions used, so a later run can skip artifacts whose inputs have not changed
+# the code version covers every module that shapes what a stage writes, not only the stage itself
+#
+# file fingerprints are compared on size & mtime first, the file is only hashed again when its mtime has moved
+
+MANIFEST_VERSION = 1
+
+
+def file_hash(file):
+    sha = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_fingerprint(file):
+    stat = os.stat(file)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': file_hash(file)}
+
+
+def fingerprint_matches(file, fingerprint):
+    # returns (matches, touched) - touched means the contents match but the mtime has moved
+    if not os.path.exists(file):
+        return False, False
+    stat = os.stat(file)
+    if stat.st_size != fingerprint['size']:
+        return False, False
+    if stat.st_mtime_ns == fingerprint['mtime']:
+        return True, False
+    if file_hash(file) != fingerprint['hash']:
+        return False, False
+    fingerprint['mtime'] = stat.st_mtime_ns
+    return True, True
+
+
+def code_version(*files):
+    # hash of the source code that builds an artifact
+    sha = hashlib.sha256()
+    for file in files:
+        sha.update(file_hash(file).encode())
+    return sha.hexdigest()
+
+
+class BuildManifest():
+
+    def __init__(self, manifest_file, code_version, metadata_version=None):
+        self.manifest_file = manifest_file
+        self.code_version = code_version
+        self.metadata_version = metadata_version
+        self.changed = False
+
+        self.artifacts = {}
+        if os.path.exists(self.manifest_file):
+            try:
+                with open(self.manifest_file) as f:
+                    manifest = json.load(f)
+                if manifest['version'] == MANIFEST_VERSION:
+                    self.artifacts = manifest['artifacts']
+            except Exception as e:
+                print(f"Manifest {self.manifest_file} could not be read, everything will be rebuilt")
+                print(e)
+
+    def is_current(self, artifact, inputs):
+        # True if artifact was recorded from exactly these inputs, none of them have changed,
+        # the code & metadata versions are the same and the artifact itself has not been touched since
+        if artifact not in self.artifacts:
+            return False
+
+        entry = self.artifacts[artifact]
+        if entry['code_version'] != self.code_version or entry['metadata_version'] != self.metadata_version:
+            return False
+
+        if sorted(entry['inputs']) != sorted(inputs):
+            return False
+
+        for file in list(inputs) + [artifact]:
+            fingerprint = entry['output'] if file == artifact else entry['inputs'][file]
+            matches, touched = fingerprint_matches(file, fingerprint)
+            if not matches:
+                return False
+            if touched:
+                self.changed = True
+
+        return True
+
+    def record(self, artifact, inputs, extra=None):
+        # call once artifact has been fully written
+        self.artifacts[artifact] = {
+            'inputs': {file: file_fingerprint(file) for file in inputs},
+            'output': file_fingerprint(artifact),
+            'code_version': self.code_version,
+            'metadata_version': self.metadata_version,
+            'extra': extra or {}
+            }
+        self.changed = True
+        return
+
+    def extra(self, artifact):
+        return self.artifacts[artifact]['extra']
+
+    def forget(self, artifact):
+        if artifact in self.artifacts:
+            del self.artifacts[artifact]
+            self.changed = True
+        return
+
+    def save(self):
+        if not self.changed:
+            return
+        temp_file = f"{self.manifest_file}.tmp"
+        with open(temp_file, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'artifacts': self.artifacts}, f, indent=1)
+        os.replace(temp_file, self.manifest_file)
+        self.changed = False
+        return
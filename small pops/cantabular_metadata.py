@@ -0,0 +1,440 @@
+import os, pickle, hashlib
+import pandas as pd
+from build_manifest import file_fingerprint, fingerprint_matches
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    from pyarrow import csv as arrow_csv
+except ImportError:
+    arrow_csv = None
+
+# in-memory catalog of the cantabular metadata files
+# each file is read once and indexed by mnemonic so lookups do not need to filter the DataFrames again
+#
+# the commissioned tables spec sheets are read in one pass and indexed by ' table number', with the variables,
+# geographies & population of each table already parsed
+#
+# the parsed catalog (including the commissioned tables spec) can be saved to a binary snapshot
+# which is reused until one of the source files changes
+#
+# only the columns used are read from each file, through pyarrow's multithreaded csv reader if it is installed
+# a catalog for a few datasets (e.g. a run of some transforms_to_run) works out which datasets, variables & classifications
+# those datasets need from Dataset_Variable.csv & the spec and keeps only their rows of the other files,
+# it is never saved as the snapshot but a current snapshot or a full catalog already loaded is used instead of building one
+
+SNAPSHOT_VERSION = 5 # bumped whenever the attributes of CantabularMetadata change, older snapshots are rebuilt
+
+# values read as missing (NaN) - pd.read_csv's defaults as of pandas 1.5, fixed here so every pandas version
+# and both the pyarrow & pandas readers read the files the same
+na_values = [
+        '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', 
+        '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'n/a', 'nan', 'null'
+        ]
+
+cantabular_files = ["Variable.csv", "Dataset.csv", "Dataset_Variable.csv", "Classification.csv", "Category.csv", "Source.csv"]
+commission_tables_sheets = ["EILR", "COB"] # a table number in more than one sheet is taken from the first
+area_type_lookup = {'national': 'nat', 'country': 'ctry', 'region': 'rgn'} # spec geography names that are not area type mnemonics
+classification_variables = {'economic_activity_status': 'economic_activity'} # classifications whose variable is not the name before the suffix
+
+
+class CantabularMetadata():
+
+    def __init__(self, cantabular_files_path, commission_tables_metadata=None, datasets=None):
+        self.cantabular_files_path = cantabular_files_path
+        self.commission_tables_metadata = commission_tables_metadata
+        # None loads every dataset, otherwise only what these datasets need
+        self.selected_datasets = None if datasets is None else sorted(set(datasets))
+        self.needed_datasets = self._needed_datasets()
+
+        self._load_commission_tables_metadata()
+        self._load_dataset_variables()
+        self._find_needed_mnemonics()
+        self._load_variables()
+        self._load_datasets()
+        self._load_classifications()
+        self._load_categories()
+        self._load_source()
+        
+        # hash of the source files, set by whoever loads the catalog
+        self.version = None
+
+    def has_dataset(self, dataset_mnemonic):
+        return dataset_mnemonic in self.datasets
+
+    def dataset(self, dataset_mnemonic):
+        # title, description, statistical_unit, population
+        if dataset_mnemonic not in self.datasets:
+            raise KeyError(f"{dataset_mnemonic} not found in Dataset.csv")
+        return self.datasets[dataset_mnemonic]
+
+    def dataset_variables(self, dataset_mnemonic):
+        # variables of a dataset in file order - {variable: {'classification', 'lowest_geog_flag'}}
+        return self.dataset_variable_lookup.get(dataset_mnemonic, {})
+
+    def variable(self, variable_mnemonic):
+        # title, description, quality_statement, quality_statement_url, topic, type_code
+        if variable_mnemonic not in self.variables:
+            raise KeyError(f"{variable_mnemonic} not found in Variable.csv")
+        return self.variables[variable_mnemonic]
+
+    def classification_label(self, classification_mnemonic):
+        if classification_mnemonic not in self.classifications:
+            raise KeyError(f"{classification_mnemonic} not found in Classification.csv")
+        return self.classifications[classification_mnemonic]
+
+    def category_codes(self, classification_mnemonic):
+        # label -> code lookup for a classification
+        return self.categories.get(classification_mnemonic, {}).copy()
+
+    def has_commission_table(self, table_number):
+        return table_number in self.commission_tables
+
+    def commission_table(self, table_number):
+        # sheet, rows, title, description, classifications, variables ({variable: classification}), area_types, population
+        # rows - how many rows of the sheet have the table number, the rest come from the first
+        if table_number not in self.commission_tables:
+            raise KeyError(f"{table_number} not found in commissioned tables spec - {self.commission_tables_metadata}")
+        return self.commission_tables[table_number]
+
+    def source_files(self):
+        # every file the catalog was built from
+        return source_files(self.cantabular_files_path, self.commission_tables_metadata)
+
+    def _read(self, file_name, usecols, keep=None):
+        # keep - (column, mnemonics), only rows with one of the mnemonics in column are kept
+        file = f"{self.cantabular_files_path}/{file_name}"
+        if arrow_csv is None:
+            df = pd.read_csv(file, usecols=usecols, keep_default_na=False, na_values=na_values)
+            if keep is not None:
+                df = df[df[keep[0]].isin(keep[1])]
+            return df
+        
+        # na_values are missing (NaN) and dates are left as text, same as pd.read_csv
+        table = arrow_csv.read_csv(file, convert_options=arrow_csv.ConvertOptions(
+                include_columns=usecols, 
+                null_values=na_values, 
+                strings_can_be_null=True, 
+                timestamp_parsers=[]
+                ))
+        # rows are dropped before they are turned into python objects
+        if keep is not None:
+            column, mnemonics = keep
+            table = table.filter(pyarrow.compute.is_in(table[column], value_set=pyarrow.array(sorted(mnemonics), table[column].type)))
+        df = table.to_pandas()
+        for column in df.columns:
+            if table[column].null_count > 0 and df[column].dtype == object:
+                df[column] = df[column].where(df[column].notna(), float('nan'))
+        return df
+
+    def _keep(self, column, mnemonics):
+        # row filter for _read, everything is kept for a full catalog
+        if self.selected_datasets is None:
+            return None
+        return column, mnemonics
+
+    def _find_needed_mnemonics(self):
+        # variables & classifications of the selected datasets, from Dataset_Variable.csv & the commissioned tables spec
+        self.needed_variables, self.needed_classifications = set(), set()
+        if self.selected_datasets is None:
+            return
+        for dataset in self.needed_datasets:
+            for variable, details in self.dataset_variables(dataset).items():
+                self.needed_variables.add(variable)
+                self.needed_classifications.add(details['classification'])
+            if self.has_commission_table(dataset):
+                self.needed_variables.update(self.commission_table(dataset)['variables'])
+                self.needed_classifications.update(self.commission_table(dataset)['classifications'])
+        return
+
+    def _needed_datasets(self):
+        # SPxxxA tables not in Dataset.csv take their metadata from SPxxx
+        if self.selected_datasets is None:
+            return None
+        needed = set()
+        for dataset in self.selected_datasets:
+            needed.update([dataset, dataset[:-1]])
+        return needed
+
+    def _first_rows(self, df, key, columns):
+        # first row for each mnemonic, matches the old df_loop[...].iloc[0] behaviour
+        df = df.drop_duplicates(subset=key, keep='first')
+        lookup = {}
+        for row in zip(df[key], *[df[col] for col in columns.values()]):
+            lookup[row[0]] = dict(zip(columns.keys(), row[1:]))
+        return lookup
+
+    def _load_variables(self):
+        variable_df = self._read("Variable.csv", [
+                'Variable_Mnemonic', 'Variable_Title', 'Variable_Description', 'Quality_Statement_Text', 
+                'Quality_Summary_URL', 'Topic_Mnemonic', 'Variable_Type_Code'
+                ])
+        # area types are always kept, every stage looks them up
+        if self.selected_datasets is not None:
+            variable_df = variable_df[variable_df['Variable_Mnemonic'].isin(self.needed_variables) | (variable_df['Variable_Type_Code'] == 'GEOG')]
+
+        self.variables = self._first_rows(variable_df, 'Variable_Mnemonic', {
+                'title': 'Variable_Title',
+                'description': 'Variable_Description',
+                'quality_statement': 'Quality_Statement_Text',
+                'quality_statement_url': 'Quality_Summary_URL',
+                'topic': 'Topic_Mnemonic',
+                'type_code': 'Variable_Type_Code',
+                })
+
+        # area type lookup - only GEOG variables
+        self.area_type = {}
+        df = variable_df[variable_df['Variable_Type_Code'] == 'GEOG'].drop_duplicates(subset='Variable_Mnemonic', keep='first')
+        for code, title in zip(df['Variable_Mnemonic'], df['Variable_Title']):
+            self.area_type[code] = title
+
+        del variable_df
+        return
+
+    def _load_datasets(self):
+        dataset_df = self._read(
+                "Dataset.csv", 
+                ['Dataset_Mnemonic', 'Dataset_Title', 'Dataset_Description', 'Statistical_Unit', 'Dataset_Population'], 
+                self._keep('Dataset_Mnemonic', self.needed_datasets)
+                )
+        self.datasets = self._first_rows(dataset_df, 'Dataset_Mnemonic', {
+                'title': 'Dataset_Title',
+                'description': 'Dataset_Description',
+                'statistical_unit': 'Statistical_Unit',
+                'population': 'Dataset_Population',
+                })
+        del dataset_df
+        return
+
+    def _load_dataset_variables(self):
+        dataset_variable_df = self._read(
+                "Dataset_Variable.csv", 
+                ['Dataset_Mnemonic', 'Variable_Mnemonic', 'Classification_Mnemonic', 'Lowest_Geog_Variable_Flag'], 
+                self._keep('Dataset_Mnemonic', self.needed_datasets)
+                )
+
+        self.dataset_variable_lookup = {}
+        for dataset, variable, classification, flag in zip(
+                dataset_variable_df['Dataset_Mnemonic'],
+                dataset_variable_df['Variable_Mnemonic'],
+                dataset_variable_df['Classification_Mnemonic'],
+                dataset_variable_df['Lowest_Geog_Variable_Flag']
+                ):
+            variables = self.dataset_variable_lookup.setdefault(dataset, {})
+            if variable in variables:
+                continue
+            variables[variable] = {'classification': classification, 'lowest_geog_flag': flag}
+
+        del dataset_variable_df
+        return
+
+    def _load_classifications(self):
+        classification_df = self._read(
+                "Classification.csv", 
+                ['Classification_Mnemonic', 'External_Classification_Label_English'], 
+                self._keep('Classification_Mnemonic', self.needed_classifications)
+                )
+        df = classification_df.drop_duplicates(subset='Classification_Mnemonic', keep='first')
+        self.classifications = dict(zip(df['Classification_Mnemonic'], df['External_Classification_Label_English']))
+        del classification_df
+        return
+
+    def _load_categories(self):
+        category_df = self._read(
+                "Category.csv", 
+                ['Classification_Mnemonic', 'External_Category_Label_English', 'Category_Code'], 
+                self._keep('Classification_Mnemonic', self.needed_classifications)
+                )
+
+        # later rows overwrite earlier ones, same as dict(zip(labels, codes)) on the filtered df
+        self.categories = {}
+        for classification, label, code in zip(
+                category_df['Classification_Mnemonic'],
+                category_df['External_Category_Label_English'],
+                category_df['Category_Code']
+                ):
+            self.categories.setdefault(classification, {})[label] = code
+
+        del category_df
+        return
+
+    def _load_source(self):
+        source_df = self._read("Source.csv", ['SDC_Statement'])
+        self.sdc_statement = source_df['SDC_Statement'].iloc[0]
+        del source_df
+        return
+
+    def _load_commission_tables_metadata(self):
+        self.commission_tables = {}
+        if not self.commission_tables_metadata:
+            return
+        commission_sheets = pd.read_excel(f"{self.commission_tables_metadata}", sheet_name=commission_tables_sheets)
+        
+        # first row for each table number, same as the old df_loop[...].iloc[0]
+        for sheet in commission_tables_sheets:
+            df = commission_sheets[sheet]
+            rows = df[' table number'].value_counts()
+            for table_number, title, description, variables, geography, population in zip(
+                    df[' table number'],
+                    df['table title'],
+                    df['dataset_description / Table Notes'],
+                    df['variables'],
+                    df['Geography'],
+                    df['table population']
+                    ):
+                if type(table_number) != str or table_number in self.commission_tables:
+                    continue
+                classifications = commission_table_classifications(variables)
+                self.commission_tables[table_number] = {
+                        'sheet': sheet,
+                        'rows': int(rows[table_number]),
+                        'title': title,
+                        'description': description,
+                        'classifications': classifications,
+                        'variables': {classification_variable(classification): classification for classification in classifications},
+                        'area_types': commission_table_area_types(geography),
+                        'population': population.split(':')[0].strip() if type(population) == str else None
+                        }
+                        
+        del commission_sheets
+        return
+
+
+def commission_table_classifications(variables):
+    # 'Flat classification for ethnic group, religion_tb_10a, sex' -> ['religion_tb_10a', 'sex']
+    if type(variables) != str:
+        return []
+    if variables.startswith('Flat classification'):
+        variables = variables.split('Flat classification for ethnic group, ')[-1]
+    classifications = [variable.strip().lower() for variable in variables.split(',')]
+    return [classification for classification in classifications if classification != '']
+
+
+def classification_variable(classification):
+    # religion_tb_10a -> religion_tb, names with no numbers in are the variable already
+    if not any(item.isnumeric() for item in classification):
+        return classification
+    variable = '_'.join(classification.split('_')[:-1])
+    return classification_variables.get(variable, variable)
+
+
+def commission_table_area_types(geography):
+    # 'MSOA/National' -> ['msoa', 'nat']
+    if type(geography) != str:
+        return []
+    return [area_type_lookup.get(area.lower(), area.lower()) for area in geography.split('/')]
+
+
+def source_files(cantabular_files_path, commission_tables_metadata=None):
+    files = [f"{cantabular_files_path}/{file_name}" for file_name in cantabular_files]
+    if commission_tables_metadata:
+        files.append(commission_tables_metadata)
+    return files
+
+
+def _snapshot_is_current(sources):
+    # returns (is_current, sources_changed_mtime)
+    touched = False
+    for file, fingerprint in sources.items():
+        matches, file_touched = fingerprint_matches(file, fingerprint)
+        if not matches:
+            return False, False
+        touched = touched or file_touched
+    return True, touched
+
+
+def _metadata_version(sources):
+    # changes whenever the contents of any source file change
+    sha = hashlib.sha256()
+    for file in sources:
+        sha.update(sources[file]['hash'].encode())
+    return sha.hexdigest()
+
+
+def _write_snapshot(snapshot_file, snapshot):
+    # written to a temp file first so a failed write never leaves a half written snapshot
+    folder = os.path.dirname(snapshot_file)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    temp_file = f"{snapshot_file}.tmp"
+    with open(temp_file, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file, snapshot_file)
+    return
+
+
+def current_snapshot(cantabular_files_path, commission_tables_metadata, snapshot_file):
+    # the catalog in snapshot_file, None if there is no snapshot or a source file has changed since it was written
+    if not os.path.exists(snapshot_file):
+        return None
+    try:
+        with open(snapshot_file, 'rb') as f:
+            snapshot = pickle.load(f)
+            
+        expected_files = source_files(cantabular_files_path, commission_tables_metadata)
+        if snapshot['version'] == SNAPSHOT_VERSION and list(snapshot['sources']) == expected_files:
+            is_current, touched = _snapshot_is_current(snapshot['sources'])
+            if is_current:
+                if touched:
+                    _write_snapshot(snapshot_file, snapshot)
+                snapshot['metadata'].version = _metadata_version(snapshot['sources'])
+                return snapshot['metadata']
+            
+    except Exception as e:
+        print(f"Metadata snapshot {snapshot_file} could not be used")
+        print(e)
+    return None
+
+
+def load_metadata_snapshot(cantabular_files_path, commission_tables_metadata, snapshot_file):
+    # loads the catalog from snapshot_file, rebuilding it if any source file has changed
+    metadata = current_snapshot(cantabular_files_path, commission_tables_metadata, snapshot_file)
+    if metadata is not None:
+        return metadata
+    
+    print("Building metadata snapshot")
+    sources = {file: file_fingerprint(file) for file in source_files(cantabular_files_path, commission_tables_metadata)}
+    metadata = CantabularMetadata(cantabular_files_path, commission_tables_metadata)
+    metadata.version = _metadata_version(sources)
+    _write_snapshot(snapshot_file, {'version': SNAPSHOT_VERSION, 'sources': sources, 'metadata': metadata})
+    return metadata
+
+
+# one catalog per set of source files, shared by every stage run in the same process
+_catalogs = {}
+
+def get_cantabular_metadata(cantabular_files_path, commission_tables_metadata=None, snapshot_file=None, datasets=None):
+    # datasets - only the metadata these datasets need is loaded, unless the full catalog is already loaded or in a current snapshot
+    key = (cantabular_files_path, commission_tables_metadata)
+    if datasets is not None and key not in _catalogs:
+        return _get_selected_metadata(cantabular_files_path, commission_tables_metadata, snapshot_file, datasets)
+    
+    if key not in _catalogs:
+        if snapshot_file:
+            _catalogs[key] = load_metadata_snapshot(cantabular_files_path, commission_tables_metadata, snapshot_file)
+        else:
+            _catalogs[key] = _build_metadata(cantabular_files_path, commission_tables_metadata)
+    return _catalogs[key]
+
+
+def _get_selected_metadata(cantabular_files_path, commission_tables_metadata, snapshot_file, datasets):
+    key = (cantabular_files_path, commission_tables_metadata)
+    if snapshot_file:
+        metadata = current_snapshot(cantabular_files_path, commission_tables_metadata, snapshot_file)
+        if metadata is not None:
+            _catalogs[key] = metadata
+            return metadata
+    
+    selected_key = key + (tuple(sorted(set(datasets))),)
+    if selected_key not in _catalogs:
+        print(f"Loading metadata for {len(selected_key[-1])} datasets")
+        _catalogs[selected_key] = _build_metadata(cantabular_files_path, commission_tables_metadata, datasets)
+    return _catalogs[selected_key]
+
+
+def _build_metadata(cantabular_files_path, commission_tables_metadata, datasets=None):
+    # a catalog read from the source files without a snapshot, versioned by their contents
+    sources = {file: file_fingerprint(file) for file in source_files(cantabular_files_path, commission_tables_metadata)}
+    metadata = CantabularMetadata(cantabular_files_path, commission_tables_metadata, datasets)
+    metadata.version = _metadata_version(sources)
+    return metadata
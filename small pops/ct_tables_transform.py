@@ -1,6 +1,18 @@
-import os, datetime, math, json
+import os, datetime, math, json, inspect
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
-from databaker.framework import *
+try:
+    # only used by legacy transform scripts, which are run with the globals of this module
+    from databaker.framework import *
+except ImportError:
+    pass
+from cantabular_metadata import get_cantabular_metadata
+from transform_loader import load_transform, load_transform_code, defines_run
+from table_io import intermediate_file, read_table, write_table, remove_if_replaced, iter_table, write_chunks
+from build_manifest import BuildManifest, code_version
+from stage_profile import StageProfile, count_rows
+from validation import validate_tables
+import table_io, cantabular_metadata, transform_loader, sheet_extractor
 
 class run_transforms_commission_tables():
     
@@ -13,6 +25,14 @@ class run_transforms_commission_tables():
         self.output_location = "census-outputs/ct" 
         self.cantabular_files_path = ""
         self.commission_tables_metadata = "sp-data/commissioned tables small pops spec 09062023.xlsx"
+        self.metadata_snapshot = "sp-data/metadata-snapshot.pickle"
+        self.number_of_workers = 1 # more than 1 runs the transform scripts in a process pool
+        self.intermediate_format = "xlsx" # "parquet" or "arrow" hands tidy data to final_transforms in a columnar format (needs pyarrow)
+        self.incremental = True # skips datasets whose transform, source files, metadata & code are unchanged since the last run
+        self.memory_budget_mb = None # e.g. 512 - tables are tidied in chunks of rows that fit the budget instead of all at once
+        self.profile_report = None # e.g. "census-outputs/ct-profile.json" - writes time, memory & rows of each dataset & phase at the end of a run
+        self.validate = True # checks each transformed table before it is tidied & leaves out those with problems, reported all together at the end (read in chunks an extra time with a memory budget)
+        self.validation_report = None # e.g. "census-outputs/ct-validation.json" - writes every problem found by the checks
         ##########
         
         if self.location_of_scripts.endswith("/"):
@@ -26,95 +46,116 @@ class run_transforms_commission_tables():
         if type(self.transforms_to_run) == str:
             self.transforms_to_run = [self.transforms_to_run]
         
-        self.transform_files = [f for f in os.listdir(self.location_of_scripts) if not f.startswith('.')]
+        # only .py files, transforms are compiled into a __pycache__ folder alongside them
+        self.transform_files = [f for f in os.listdir(self.location_of_scripts) if not f.startswith('.') and f.endswith('.py')]
         self._get_transform_files()
         
         self.transform_status = {}
         self._get_area_metadata()
         
         self.run_scripts_incomplete = []
+        self.validation_failed = []
         self.tidy_data_incomplete = []
         self.add_metadata_incomplete = []
         
         self.number_of_scripts = len(self.transform_files) 
         
+        self.manifest = BuildManifest(
+                f"{self.output_location}/.manifest.json", 
+                code_version(__file__, table_io.__file__, cantabular_metadata.__file__, transform_loader.__file__, sheet_extractor.__file__), 
+                self.metadata.version
+                )
+        self.transforms_to_build = self.transform_files
+        self.unchanged_transforms = []
+        self.profile = StageProfile('ct')
+        
     def run(self):
+        self._find_unchanged_transforms()
         self._run_scripts() 
-        self._get_metadata()
+        with self.profile.phase('metadata'):
+            self._get_metadata()
         self._tidy_data()
+        self.manifest.save()
         self._print_outcomes()
+        self.profile.save(self.profile_report)
+        
+        return
+    
+    def _transform_inputs(self, transform):
+        # transform script plus any source file named after the dataset (SP101A_*.xlsx / SP101A.xlsx)
+        if not hasattr(self, 'source_file_names'):
+            self.source_file_names = sorted(f for f in os.listdir(self.location_of_source_files) if not f.startswith('.'))
+            
+        inputs = [f"{self.location_of_scripts}/{transform}.py"]
+        for file in self.source_file_names:
+            if file.startswith(f"{transform}_") or file.startswith(f"{transform}."):
+                inputs.append(f"{self.location_of_source_files}/{file}")
+        return inputs
+    
+    def _find_unchanged_transforms(self):
+        # datasets whose tidy output was built from the same inputs are not transformed or tidied again
+        self.transforms_to_build = []
+        self.unchanged_transforms = []
+        
+        for transform in self.transform_files:
+            tidy_file = intermediate_file(self.output_location, transform, self.intermediate_format)
+            if self.incremental and self.manifest.is_current(tidy_file, self._transform_inputs(transform)):
+                self.unchanged_transforms.append(transform)
+                self.transform_status[transform] = {
+                        'output_file': tidy_file, 
+                        'area_types': self.manifest.extra(tidy_file)['area_types'], 
+                        'unchanged': True
+                        }
+            else:
+                self.transforms_to_build.append(transform)
+                
+        if self.unchanged_transforms != []:
+            print(f"{len(self.unchanged_transforms)} commission tables unchanged since the last run - {self.unchanged_transforms}")
         
         return
     
     def _tidy_data(self):
         # will open excel data file, sort columns and dimensions (add code columns), turn into required tidy data format
+        # each table is read once, checked, tidied if it has no problems & let go before the next one is read
+        # the problems found by the checks are reported all together at the end
+        validation = validate_tables(self.validation_report) if self.validate else None
+        count = 1
         for dataset_id in self.transform_status:
-            count = 1
-            print(f"Tidying data for {dataset_id} - {count} of {self.number_of_scripts}")
+            if self.transform_status[dataset_id].get('unchanged'):
+                continue
+            
+            df = None
+            if validation:
+                df = validation.commission_table(self, dataset_id, keep=not self.memory_budget_mb)
+                if dataset_id in validation.report.datasets():
+                    continue
+            
+            print(f"Tidying data for {dataset_id} - {count} of {len(self.transforms_to_build)}")
             try:
                 dataset_file = self.transform_status[dataset_id]['output_file']
-                xlsx = pd.ExcelFile(dataset_file)
-                df = pd.read_excel(xlsx, dtype=str)
-            
-                area_lookup = self.metadata_dict['area_type']
-                def area_type_label(value):
-                    return area_lookup[value]
-                
-                # create code columns
-                # re-order columns
-                # rename columns
-                # get dimension codes and apply them
+                tidy_file = intermediate_file(self.output_location, dataset_id, self.intermediate_format)
                 
-                new_column_order = []
-                
-                for col in df.columns:
-                    if col == 'OBS':
-                        df['Count'] = df['OBS']
-                    
-                    elif col == 'small_population':
-                        df['Geography Code'] = df['small_population'].apply(lambda x: x.split(' ')[0])
-                        new_column_order.append('Geography Code')
-                        
-                        df['Geography Label'] = df['small_population'].apply(lambda x: ' '.join(x.split(' ')[1:]))
-                        new_column_order.append('Geography Label')
-                    
-                    elif col == 'area_type':
-                        df['Area type'] = df['area_type'].apply(area_type_label)
-                        new_column_order.append('Area type')
-                    
+                with self.profile.phase('tidy', dataset_id) as record:
+                    if self.memory_budget_mb:
+                        chunks = count_rows(iter_table(dataset_file, self.memory_budget_mb, compact=True), record, 'rows_in')
+                        write_chunks(tidy_file, count_rows((self._tidy_dataframe(dataset_id, chunk) for chunk in chunks), record, 'rows_out'))
                     else:
-                        variable = col.split(' ')[0]
-                        variable_label = self.metadata_dict[dataset_id]['variables'][variable]['classification_label']
-                        
-                        label_to_code_dict = self.metadata_dict[dataset_id]['variables'][variable]['category'].copy()
-                        
-                        def label_to_codes(value):
-                            if value not in label_to_code_dict.keys():
-                                raise Exception(f"{value} not found in label_to_code_dict")
-                            
-                            return label_to_code_dict[value]
-                        
-                        df[f'{variable_label} Code'] = df[col].apply(label_to_codes)
-                        new_column_order.append(f'{variable_label} Code')
-                        
-                        df[f'{variable_label} Label'] = df[col] 
-                        new_column_order.append(f'{variable_label} Label')
-                        
-                        del label_to_code_dict
-                        
-                new_column_order.append('Count')
-                df = df[new_column_order]
-                
-                # putting column names in df to avoid bold headers in excel
-                df = df.reset_index(drop=True)
-                df.index = df.index+1  
-                df.loc[0] = df.columns
-                df = df.sort_index()
-                # making column headers not bold
-                #pd.io.formats.excel.ExcelFormatter.header_style = None
+                        if df is None:
+                            df = read_table(dataset_file, compact=True)
+                        record['rows_in'] = len(df)
+                        df = self._tidy_dataframe(dataset_id, df)
+                        record['rows_out'] = len(df)
+                        write_table(df, tidy_file)
+                    
+                remove_if_replaced(dataset_file, tidy_file)
+                self.transform_status[dataset_id]['output_file'] = tidy_file
                 
-                with pd.ExcelWriter(dataset_file, engine='openpyxl') as writer:
-                    df.to_excel(writer, sheet_name='Data', index=False, header=False)
+                if dataset_id in self.transform_files:
+                    self.manifest.record(
+                            tidy_file, 
+                            self._transform_inputs(dataset_id), 
+                            extra={'area_types': self.transform_status[dataset_id]['area_types']}
+                            )
                     
                 print(f"{dataset_id} now in tidy data format")
                     
@@ -125,22 +166,86 @@ class run_transforms_commission_tables():
                 
             count += 1
         
+        if validation:
+            self.validation_failed = validation.finish()
+        
         return 
     
+    def _tidy_dataframe(self, dataset_id, df):
+        # create code columns
+        # re-order columns
+        # rename columns
+        # get dimension codes and apply them
+        # every column is mapped in one vectorized pass, unmapped values are collected and reported together
+        area_lookup = self.metadata_dict['area_type']
+        
+        new_column_order = self._tidy_column_names(dataset_id, df.columns)
+        unmapped = {}
+        
+        for col in list(df.columns):
+            if col == 'OBS':
+                df['Count'] = df['OBS']
+            
+            elif col == 'small_population':
+                geography = df['small_population'].str.partition(' ')
+                df['Geography Code'] = geography[0]
+                df['Geography Label'] = geography[2]
+            
+            elif col == 'area_type':
+                df['Area type'] = df['area_type'].map(area_lookup)
+                
+                not_found = df.loc[~df['area_type'].isin(area_lookup.keys()), 'area_type'].unique()
+                if len(not_found) != 0:
+                    unmapped[col] = list(not_found)
+            
+            else:
+                variable = col.split(' ')[0]
+                variable_label = self.metadata_dict[dataset_id]['variables'][variable]['classification_label']
+                
+                label_to_code_dict = self.metadata_dict[dataset_id]['variables'][variable]['category']
+                
+                df[f'{variable_label} Code'] = df[col].map(label_to_code_dict)
+                df[f'{variable_label} Label'] = df[col] 
+                
+                not_found = df.loc[~df[col].isin(label_to_code_dict.keys()), col].unique()
+                if len(not_found) != 0:
+                    unmapped[col] = list(not_found)
+        
+        if unmapped:
+            raise Exception(f"{dataset_id} - values not found in label_to_code_dict {unmapped}")
+                
+        return df[new_column_order]
+    
+    def _tidy_column_names(self, dataset_id, columns):
+        # columns of the tidy table made from a transformed table with these columns, in order
+        new_column_order = []
+        for col in columns:
+            if col == 'small_population':
+                new_column_order += ['Geography Code', 'Geography Label']
+            
+            elif col == 'area_type':
+                new_column_order.append('Area type')
+            
+            elif col != 'OBS':
+                variable_label = self.metadata_dict[dataset_id]['variables'][col.split(' ')[0]]['classification_label']
+                new_column_order += [f'{variable_label} Code', f'{variable_label} Label']
+        
+        new_column_order.append('Count')
+        return new_column_order
+    
     def _run_scripts(self):
         # runs selected transform(s)
+        if self.number_of_workers > 1 and len(self.transforms_to_build) > 1:
+            self._run_scripts_in_parallel()
+            return
+        
         count = 1
-        for transform in self.transform_files:
-            print(f"Running transform on {transform} - {count} of {self.number_of_scripts}")
-            loc = {}
-            with open(f"{self.location_of_scripts}/{transform}.py") as f:
-                script = f.read()
-                
-            script = script.replace("source_location = \"\"", f"source_location = \"{self.location_of_source_files}\"")
-            script = script.replace("output_location = \"\"", f"output_location = \"{self.output_location}\"")
+        for transform in self.transforms_to_build:
+            print(f"Running transform on {transform} - {count} of {len(self.transforms_to_build)}")
             try:
-                exec(script, globals(), loc)
-                self.transform_status.update(loc['output'])
+                with self.profile.phase('script_run', transform):
+                    output = _run_transform_script(self.location_of_scripts, transform, self.location_of_source_files, self.output_location, self.intermediate_format)
+                self.transform_status.update(output)
             except Exception as e:
                 print(f"Error in _run_scripts for {transform}")
                 print(e)
@@ -150,6 +255,33 @@ class run_transforms_commission_tables():
         
         return
     
+    def _run_scripts_in_parallel(self):
+        # runs selected transform(s) across a process pool
+        # results are merged in transform_files order so the outcome does not depend on which worker finishes first
+        # profiled as one script_run phase, the scripts themselves run in the workers
+        print(f"Running {len(self.transforms_to_build)} transforms across {self.number_of_workers} workers")
+        with self.profile.phase('script_run'), ProcessPoolExecutor(max_workers=self.number_of_workers) as executor:
+            futures = {}
+            for transform in self.transforms_to_build:
+                futures[transform] = executor.submit(
+                        _run_transform_script, self.location_of_scripts, transform, self.location_of_source_files, self.output_location, self.intermediate_format
+                        )
+                
+            count = 1
+            for transform in self.transforms_to_build:
+                try:
+                    output = futures[transform].result()
+                    self.transform_status.update(output)
+                    print(f"Transform complete for {transform} - {count} of {len(self.transforms_to_build)}")
+                except Exception as e:
+                    print(f"Error in _run_scripts for {transform}")
+                    print(e)
+                    self.run_scripts_incomplete.append(transform)
+                    
+                count += 1
+                
+        return
+    
     def _get_transform_files(self):
         # gets the list of transform files to run
         new_transform_files = []
@@ -172,63 +304,50 @@ class run_transforms_commission_tables():
     
     def _get_area_metadata(self):
         # gets some inital metadata for area types
+        # a run of some transforms only loads the metadata those datasets need
+        datasets = None if self.transforms_to_run == ["*"] else self.transform_files
+        self.metadata = get_cantabular_metadata(self.cantabular_files_path, self.commission_tables_metadata, self.metadata_snapshot, datasets)
         self.metadata_dict = {}
-        self.metadata_dict['area_type'] = {}
-        variable_df = pd.read_csv(f"{self.cantabular_files_path}/Variable.csv")
-        df = variable_df[variable_df['Variable_Type_Code'] == 'GEOG']
-        for code in df['Variable_Mnemonic'].unique():
-            df_loop = df[df['Variable_Mnemonic'] == code]
-            self.metadata_dict['area_type'][code] = df_loop['Variable_Title'].iloc[0]
+        self.metadata_dict['area_type'] = self.metadata.area_type.copy()
         return
     
     def _get_metadata(self):
         # gets all the metadata 
         print("Fetching metadata")
         
-        dataset_df = pd.read_csv(f"{self.cantabular_files_path}/Dataset.csv")
-        commission_metadata_df = pd.read_excel(f"{self.commission_tables_metadata}", sheet_name="EILR")
+        # transforms can output datasets named differently to the script
+        self._load_metadata_for(self.transform_status)
         
         for dataset_id in self.transform_status:
             if dataset_id.startswith("SP2") or dataset_id in ("SP115A", "SP116A", "SP117A", "SP118A", "SP119A"):
-                df_loop = commission_metadata_df[commission_metadata_df[' table number'] == dataset_id]
+                commission_table = self.metadata.commission_table(dataset_id)
                 
                 self.metadata_dict[dataset_id] = {}
-                self.metadata_dict[dataset_id]['dataset_title'] = df_loop['table title'].iloc[0]
-                self.metadata_dict[dataset_id]['dataset_description'] = df_loop['dataset_description / Table Notes'].iloc[0]
+                self.metadata_dict[dataset_id]['dataset_title'] = commission_table['title']
+                self.metadata_dict[dataset_id]['dataset_description'] = commission_table['description']
                 self.metadata_dict[dataset_id]['dataset_statistical_unit'] = "Person"
             
             elif dataset_id.startswith("SP1"):
-                df_loop = dataset_df[dataset_df['Dataset_Mnemonic'] == dataset_id]
-                
-                if len(df_loop) == 0:
-                    self.transform_status[dataset_id]['real_id'] = dataset_id[:-1]
-                else:
+                if self.metadata.has_dataset(dataset_id):
                     self.transform_status[dataset_id]['real_id'] = dataset_id
+                else:
+                    self.transform_status[dataset_id]['real_id'] = dataset_id[:-1]
                     
-                df_loop = dataset_df[dataset_df['Dataset_Mnemonic'] == self.transform_status[dataset_id]['real_id']]
+                dataset = self.metadata.dataset(self.transform_status[dataset_id]['real_id'])
                 
                 self.metadata_dict[dataset_id] = {}
-                self.metadata_dict[dataset_id]['dataset_title'] = df_loop['Dataset_Title'].iloc[0]
-                self.metadata_dict[dataset_id]['dataset_description'] = df_loop['Dataset_Description'].iloc[0]
-                self.metadata_dict[dataset_id]['dataset_statistical_unit'] = df_loop['Statistical_Unit'].iloc[0]   
+                self.metadata_dict[dataset_id]['dataset_title'] = dataset['title']
+                self.metadata_dict[dataset_id]['dataset_description'] = dataset['description']
+                self.metadata_dict[dataset_id]['dataset_statistical_unit'] = dataset['statistical_unit']
                 
             else:
                 raise TypeError(f"{dataset_id} should start SP1 or SP2")
         
-        del dataset_df
-        
-        source_df = pd.read_csv(f"{self.cantabular_files_path}/Source.csv")
-        statement = source_df['SDC_Statement'].iloc[0]
-        
         for dataset_id in self.metadata_dict:
             if dataset_id == 'area_type':
                 continue
             
-            self.metadata_dict[dataset_id]['source_sdc_statement'] = statement    
-        
-        del source_df, statement
-        
-        dataset_variable_df = pd.read_csv(f"{self.cantabular_files_path}/Dataset_Variable.csv")
+            self.metadata_dict[dataset_id]['source_sdc_statement'] = self.metadata.sdc_statement
         
         for dataset_id in self.metadata_dict:
             if dataset_id == 'area_type':
@@ -236,93 +355,53 @@ class run_transforms_commission_tables():
             
             if dataset_id.startswith("SP2") or dataset_id in ("SP115A", "SP116A", "SP117A", "SP118A", "SP119A"):
                 
-                df_loop = commission_metadata_df[commission_metadata_df[' table number'] == dataset_id]
+                commission_table = self.metadata.commission_table(dataset_id)
                 
                 self.metadata_dict[dataset_id]['area_types'] = {}
                 self.metadata_dict[dataset_id]['variables'] = {}
                 
-                variables_list = df_loop['variables'].iloc[0]
-                if variables_list.startswith('Flat classification'):
-                    variables_list = variables_list.split('Flat classification for ethnic group, ')[-1]
-                
-                variables_list = variables_list.split(',')
-                variables_list = [variable.strip().lower() for variable in variables_list]
-                
-                for variable in variables_list:
-                    if variable == '':
-                        continue
-                    is_correct_variable_name = True
-                    for item in variable:
-                        if item.isnumeric():
-                            is_correct_variable_name = False
-                            
-                    if is_correct_variable_name:
-                        correct_variable_name = variable
-                    else:
-                        correct_variable_name = '_'.join(variable.split('_')[:-1])
-                        if correct_variable_name == 'economic_activity_status':
-                            correct_variable_name = 'economic_activity'
-                    
-                    self.metadata_dict[dataset_id]['variables'][correct_variable_name] = {}
-                    self.metadata_dict[dataset_id]['variables'][correct_variable_name]['classification'] = variable
-                    
-                areas_list = df_loop['Geography'].iloc[0]
-                areas_list = areas_list.split('/')
-                lookup = {'national': 'nat', 'country': 'ctry', 'region': 'rgn'}
-                areas_list = [lookup.get(area.lower(), area.lower()) for area in areas_list]
+                for variable, classification in commission_table['variables'].items():
+                    self.metadata_dict[dataset_id]['variables'][variable] = {}
+                    self.metadata_dict[dataset_id]['variables'][variable]['classification'] = classification
                 
-                for area in areas_list:
+                for area in commission_table['area_types']:
                     self.metadata_dict[dataset_id]['area_types'][area] = {}
             
             elif dataset_id.startswith("SP1"):
-            
-                df_loop = dataset_variable_df[dataset_variable_df['Dataset_Mnemonic'] == self.transform_status[dataset_id]['real_id']]
                 
                 self.metadata_dict[dataset_id]['area_types'] = {}
                 self.metadata_dict[dataset_id]['variables'] = {}
                 
-                for code in df_loop['Variable_Mnemonic'].unique():
-                    df_loop_2 = df_loop[df_loop['Variable_Mnemonic'] == code]
-                    
-                    if pd.isnull(df_loop_2['Lowest_Geog_Variable_Flag'].iloc[0]):
+                dataset_variables = self.metadata.dataset_variables(self.transform_status[dataset_id]['real_id'])
+                for code in dataset_variables:
+                    if pd.isnull(dataset_variables[code]['lowest_geog_flag']):
                         self.metadata_dict[dataset_id]['variables'][code] = {}
-                        self.metadata_dict[dataset_id]['variables'][code]['classification'] = df_loop_2['Classification_Mnemonic'].iloc[0]
+                        self.metadata_dict[dataset_id]['variables'][code]['classification'] = dataset_variables[code]['classification']
                         
                     else:
                         self.metadata_dict[dataset_id]['area_types'][code] = {}
-                        
-        del dataset_variable_df, commission_metadata_df
-        
-        variable_df = pd.read_csv(f"{self.cantabular_files_path}/Variable.csv")
         
         for dataset_id in self.metadata_dict:
             if dataset_id == 'area_type':
                 continue
             
-            print(variable)
-            
             for area in self.metadata_dict[dataset_id]['area_types']:
-                df_loop = variable_df[variable_df['Variable_Mnemonic'] == area]
+                area_variable = self.metadata.variable(area)
                 
-                self.metadata_dict[dataset_id]['area_types'][area]['title'] = df_loop['Variable_Title'].iloc[0]
-                self.metadata_dict[dataset_id]['area_types'][area]['description'] = df_loop['Variable_Description'].iloc[0]
+                self.metadata_dict[dataset_id]['area_types'][area]['title'] = area_variable['title']
+                self.metadata_dict[dataset_id]['area_types'][area]['description'] = area_variable['description']
                 
             for variable in self.metadata_dict[dataset_id]['variables']:
                 print(variable)
                 if dataset_id == 'SP117A' and variable == 'religion_detailed':
                     continue
-
-                df_loop = variable_df[variable_df['Variable_Mnemonic'] == variable]
                 
-                self.metadata_dict[dataset_id]['variables'][variable]['title'] = df_loop['Variable_Title'].iloc[0]
-                self.metadata_dict[dataset_id]['variables'][variable]['description'] = df_loop['Variable_Description'].iloc[0]
-                self.metadata_dict[dataset_id]['variables'][variable]['quality_statement'] = df_loop['Quality_Statement_Text'].iloc[0]
-                self.metadata_dict[dataset_id]['variables'][variable]['quality_statement_url'] = df_loop['Quality_Summary_URL'].iloc[0]
+                variable_metadata = self.metadata.variable(variable)
                 
-        del variable_df
-        
-        category_df = pd.read_csv(f"{self.cantabular_files_path}/Category.csv")
-        classification_df = pd.read_csv(f"{self.cantabular_files_path}/Classification.csv")
+                self.metadata_dict[dataset_id]['variables'][variable]['title'] = variable_metadata['title']
+                self.metadata_dict[dataset_id]['variables'][variable]['description'] = variable_metadata['description']
+                self.metadata_dict[dataset_id]['variables'][variable]['quality_statement'] = variable_metadata['quality_statement']
+                self.metadata_dict[dataset_id]['variables'][variable]['quality_statement_url'] = variable_metadata['quality_statement_url']
         
         for dataset_id in self.metadata_dict:
             if dataset_id == 'area_type':
@@ -330,24 +409,24 @@ class run_transforms_commission_tables():
             
             for variable in self.metadata_dict[dataset_id]['variables']:                
                 classification = self.metadata_dict[dataset_id]['variables'][variable]['classification']
-                df_loop = category_df[category_df['Classification_Mnemonic'] == classification]
-                category_dict = dict(zip(df_loop['External_Category_Label_English'], df_loop['Category_Code']))
-                self.metadata_dict[dataset_id]['variables'][variable]['category'] = category_dict
-                df_loop = classification_df[classification_df['Classification_Mnemonic'] == classification]
-                self.metadata_dict[dataset_id]['variables'][variable]['classification_label'] = df_loop['External_Classification_Label_English'].iloc[0]
-                
-        del category_df, classification_df            
+                self.metadata_dict[dataset_id]['variables'][variable]['category'] = self.metadata.category_codes(classification)
+                self.metadata_dict[dataset_id]['variables'][variable]['classification_label'] = self.metadata.classification_label(classification)
             
         return     
     
+    def _load_metadata_for(self, datasets):
+        # widens a catalog loaded for some datasets if it does not cover all of datasets
+        selected = self.metadata.selected_datasets
+        if selected is not None and not set(datasets) <= set(selected):
+            self.metadata = get_cantabular_metadata(self.cantabular_files_path, self.commission_tables_metadata, self.metadata_snapshot, selected + list(datasets))
+        return
+    
     def create_new_transform(self, new_dataset_ids):
-        base_script = """
-dataset_code = ''
+        base_script = """import pandas as pd
+from table_io import intermediate_file, write_table
+from sheet_extractor import read_tabs, extract_tab, CLOSEST_ABOVE, DIRECTLY_LEFT
 
-# both variables need to be here for source files to be found & to give output location
-# do not touch
-source_location = "" 
-output_location = ""
+dataset_code = ''
 
 output_lookup = {
         'National': 'nat',
@@ -357,72 +436,42 @@ output_lookup = {
         'LTLA': 'ltla',
         }
 
-#file = f"{source_location}/{dataset_code}_.xlsx" 
-output_file = f"{output_location}/{dataset_code}.xlsx"
-
-tabs = loadxlstabs(file)
-tabs = [tab for tab in tabs if 'METADATA' not in tab.name]
 
-df_list, area_codes, obs_count_check = [], [], []
-for tab in tabs:
-    #obs_column = 'D'
-    #start_point_row_number = '10'
-    junk = tab.excel_ref('A').filter(contains_string('Created on')).expand(DOWN)
-    
-    list_of_geogs = tab.excel_ref(f"A{start_point_row_number}").fill(DOWN).is_not_blank().is_not_whitespace() - junk    
-    number_of_geogs = len(list_of_geogs)
-    #number_to_jump = len_of_dim1 * len_of_dim2
-    
-    len_of_obs = len(tab.excel_ref(f"{obs_column}{start_point_row_number}").fill(DOWN).is_not_blank().is_not_whitespace())
-    obs_count_check.append(len_of_obs)
+def run(source_location, output_location, intermediate_format="xlsx"):
+    # source_location, output_location & intermediate_format are passed in by run_transforms_commission_tables
+    #file = f"{source_location}/{dataset_code}_.xlsx" 
+    output_file = intermediate_file(output_location, dataset_code, intermediate_format)
     
-    area_code = output_lookup[' '.join(tab.name.split(' ')[1:])]
-    start_point = tab.excel_ref(f'A{start_point_row_number}')
+    tabs = read_tabs(file)
+    tabs = {tab_name: tabs[tab_name] for tab_name in tabs if 'METADATA' not in tab_name}
     
-    for i, geog in enumerate(list_of_geogs):
-        if i+1 == number_of_geogs:
-            Min = str(geog.y + 1)
-            Max = str(tab.excel_ref('A').filter(contains_string('Created on')).y)
-            
-        else:
-            Min = str(geog.y + 1)
-            
-            rest_of_geogs = tab.excel_ref(f"A{str(int(Min)+1)}:A{str(int(Min) + number_to_jump)}").is_not_blank().is_not_whitespace() - junk
-            for j, next_geog in enumerate(rest_of_geogs):
-                Max = str(next_geog.y)
-                break
+    #obs_column = 'D'
+    #start_point_row_number = '10'
+    dimensions = [
+            #('B', 'dimension1 label', CLOSEST_ABOVE),
+            #('C', 'dimension2 label', DIRECTLY_LEFT),
+            ]
     
-        geography = tab.excel_ref(f"A{Min}:A{Max}").is_not_blank().is_not_whitespace()
-        geography -= junk
-        
-        #dim1 = tab.excel_ref(f"B{Min}:B{Max}").is_not_blank().is_not_whitespace()
-        
-        #dim2 = tab.excel_ref(f"C{Min}:C{Max}").is_not_blank().is_not_whitespace()
+    df_list, area_codes, obs_count_check = [], [], []
+    for tab_name in tabs:
+        area_code = output_lookup[' '.join(tab_name.split(' ')[1:])]
         
-        obs = tab.excel_ref(f"{obs_column}{Min}:{obs_column}{Max}").is_not_blank().is_not_whitespace()
+        # every geography block on the tab in one go
+        df, obs_count = extract_tab(tabs[tab_name], start_point_row_number, obs_column, area_code, dimensions)
+        df_list.append(df)
+        obs_count_check.append(obs_count)
         
-        if len(obs) != 0:
-            dimensions = [
-                    HDim(geography, 'small_population', CLOSEST, ABOVE),
-                    HDimConst('area_type', area_code),
-                    #HDim(dimension1, 'dimension1 label',  CLOSEST, ABOVE),
-                    #HDim(dimension2, 'dimension2 label', DIRECTLY, LEFT),
-                    ]
-            
-            cs = ConversionSegment(tab, dimensions, obs).topandas()
-            df_list.append(cs) 
+        area_codes.append(area_code)
     
-    area_codes.append(area_code)
-
-df = pd.concat(df_list)
-assert len(df) == sum(obs_count_check), f"df length - {len(df)} does not match sum of obs {sum(obs_count_check)}"
-
-with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
-    df.to_excel(writer, sheet_name='data', index=False)
+    df = pd.concat(df_list)
+    assert len(df) == sum(obs_count_check), f"df length - {len(df)} does not match sum of obs {sum(obs_count_check)}"
     
-print(f"{dataset_code} - transform complete")
-
-output = {dataset_code: {"output_file": output_file, "area_types": area_codes}}
+    write_table(df, output_file, sheet_name='data')
+        
+    print(f"{dataset_code} - transform complete")
+    
+    # obs_count is checked again against the rows written with the other validation checks
+    return {dataset_code: {"output_file": output_file, "area_types": area_codes, "obs_count": sum(obs_count_check)}}
 
 """
         
@@ -431,10 +480,9 @@ output = {dataset_code: {"output_file": output_file, "area_types": area_codes}}
             
         assert type(new_dataset_ids) == list, "new_dataset_ids must be a list"
         
-        # get dimensions used in data
-        dataset_variable_df = pd.read_csv(f"{self.cantabular_files_path}/Dataset_Variable.csv")
-        commission_metadata_df = pd.read_excel(f"{self.commission_tables_metadata}", sheet_name="EILR")
+        self._load_metadata_for(new_dataset_ids)
         
+        # get dimensions used in data
         for dataset_id in new_dataset_ids:
             script = base_script
             if os.path.isfile(f"{self.location_of_scripts}/{dataset_id}.py"):
@@ -443,27 +491,18 @@ output = {dataset_code: {"output_file": output_file, "area_types": area_codes}}
             
             if dataset_id.startswith('SP1'):
             
-                df_loop = dataset_variable_df[dataset_variable_df['Dataset_Mnemonic'] == dataset_id]
-                if len(df_loop) == 0:
-                    df_loop = dataset_variable_df[dataset_variable_df['Dataset_Mnemonic'] == dataset_id[:-1]]
+                dataset_variables = self.metadata.dataset_variables(dataset_id)
+                if len(dataset_variables) == 0:
+                    dataset_variables = self.metadata.dataset_variables(dataset_id[:-1])
                 
                 table_dimensions = []
-                for code in df_loop['Variable_Mnemonic'].unique():
-                    df_loop_2 = df_loop[df_loop['Variable_Mnemonic'] == code]
-                    if pd.isnull(df_loop_2['Lowest_Geog_Variable_Flag'].iloc[0]):
+                for code in dataset_variables:
+                    if pd.isnull(dataset_variables[code]['lowest_geog_flag']):
                         table_dimensions.append(code)
                         
             elif dataset_id.startswith('SP2') or dataset_id in ("SP115A", "SP116A", "SP117A", "SP118A", "SP119A"):
                 
-                df_loop = commission_metadata_df[commission_metadata_df[' table number'] == dataset_id]
-                
-                variables_list = df_loop['variables'].iloc[0]
-                if variables_list.startswith('Flat classification'):
-                    variables_list = variables_list.split('Flat classification for ')[-1]
-                
-                variables_list = variables_list.split(',')
-                variables_list = [variable.strip().lower() for variable in variables_list]
-                table_dimensions = variables_list
+                table_dimensions = self.metadata.commission_table(dataset_id)['classifications']
                     
             script = script.replace("dataset_code = ''", f"dataset_code = '{dataset_id}'")
             script += "# for use in building transform\n"
@@ -487,16 +526,45 @@ output = {dataset_code: {"output_file": output_file, "area_types": area_codes}}
         else:
             print("All commission tables have been transformed")
             
+        if self.validation_failed != []:
+            print("Failed validation so not tidied")
+            print(self.validation_failed, '\n')
+            
         if self.tidy_data_incomplete != []:
             print("_tidy_data that errored")
             print(self.tidy_data_incomplete, '\n')
             
-        else:
+        elif self.validation_failed == []:
             print("All commission tables have been transformed into tidy data")
             
         
         
 
+def _run_transform_script(location_of_scripts, transform, location_of_source_files, output_location, intermediate_format="xlsx"):
+    # runs a single transform script and returns its output dict
+    # kept at module level so it can be sent to a process pool
+    transform_file = f"{location_of_scripts}/{transform}.py"
+    if defines_run(load_transform_code(transform_file)):
+        module = load_transform(transform_file)
+        if 'intermediate_format' in inspect.signature(module.run).parameters:
+            return module.run(location_of_source_files, output_location, intermediate_format=intermediate_format)
+        return module.run(location_of_source_files, output_location)
+    
+    return _run_legacy_transform_script(transform_file, location_of_source_files, output_location)
+
+
+def _run_legacy_transform_script(transform_file, location_of_source_files, output_location):
+    # older transforms have source_location & output_location patched in and run on exec
+    loc = {}
+    with open(transform_file) as f:
+        script = f.read()
+        
+    script = script.replace("source_location = \"\"", f"source_location = \"{location_of_source_files}\"")
+    script = script.replace("output_location = \"\"", f"output_location = \"{output_location}\"")
+    exec(script, globals(), loc)
+    return loc['output']
+
+
 if __name__ == '__main__':
     transform_object = run_transforms_commission_tables(
             transforms_to_run=['*']
@@ -1,7 +1,12 @@
 import os, shutil
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
-from openpyxl import load_workbook
-from databaker.framework import *
+from cantabular_metadata import get_cantabular_metadata
+from table_io import read_table, write_table, to_text, iter_table, write_chunks, concat_tables, compact_dtypes, add_xlsx_sheet, prefetch
+from build_manifest import BuildManifest, code_version
+from stage_profile import StageProfile, count_rows
+from validation import validate_tables
+import table_io, cantabular_metadata
 
 
 # assuming that all commission tables starting SP1 will be combined
@@ -20,6 +25,14 @@ class combine_and_add_metadata():
         self.output_location = "census-outputs/final"
         self.commission_tables_metadata = "sp-data/commissioned tables small pops spec 09062023.xlsx"
         self.location_of_ct_source_files = "sp-data/ct"
+        self.metadata_snapshot = "sp-data/metadata-snapshot.pickle"
+        self.incremental = True # skips final tables whose tidy inputs, metadata & code are unchanged since the last run
+        self.number_of_workers = 1 # more than 1 combines the outputs tables of different datasets in a process pool
+        self.memory_budget_mb = None # e.g. 512 - tables are combined in chunks of rows that fit the budget (per worker) instead of all at once
+        self.prefetch_tables = 2 # tables read ahead in background threads while the current one is combined & written, 0 reads each when it is reached (not used with a memory budget)
+        self.profile_report = None # e.g. "census-outputs/final-profile.json" - writes time, memory & rows of each dataset & phase at the end of a run
+        self.validate = True # checks the columns of every commission table against the outputs tables it is combined with before combining, final tables with problems are not built
+        self.validation_report = None # e.g. "census-outputs/final-validation.json" - writes every problem found by the checks
         ##########
         
         self.commission_tables_files = [f for f in os.listdir(self.commission_tables_tidy_data_location) if not f.startswith('.')]
@@ -27,17 +40,100 @@ class combine_and_add_metadata():
         
         self._create_dataset_dict()
         self.metadata_dict = {}
+        self.metadata = get_cantabular_metadata(self.cantabular_files_path, self.commission_tables_metadata, self.metadata_snapshot)
         
         self.commission_tables_count = len(self.commission_tables_files)
         self.outputs_tables_count = len(self.outputs_tables_files)
-                
+        
+        self.manifest = BuildManifest(
+                f"{self.output_location}/.manifest.json", 
+                code_version(__file__, table_io.__file__, cantabular_metadata.__file__), 
+                self.metadata.version
+                )
+        self.unchanged = []
+        self.validation_failed = []
+        self.add_metadata_incomplete = []
+        self.profile = StageProfile('final')
         
     def run(self):
+        self._find_unchanged_datasets()
+        self._validate()
         self._combine_outputs_tables()
         self._combine_commission_and_outputs_tables()
-        self._get_metadata()
+        with self.profile.phase('metadata'):
+            self._get_metadata()
         self._add_metadata()
+        self.manifest.save()
         self._print_outcomes()
+        self.profile.save(self.profile_report)
+        return
+    
+    def _final_dataset_id(self, table_type, dataset):
+        # the final table a commission or outputs table ends up in
+        if table_type == 'outputs_tables':
+            return self.dataset_dict['outputs_tables'][dataset]['dataset_id']
+        
+        if self.dataset_dict['commission_tables'][dataset]['to_combine']:
+            return self.dataset_dict['commission_tables'][dataset]['combine_with']
+        return dataset
+    
+    def _find_unchanged_datasets(self):
+        # final tables whose tidy inputs have not changed since they were built are left as they are
+        # only the final tables touched by a changed msoa_SPxxx / SPxxxA etc input are combined again
+        self.final_inputs = {}
+        for table_type in ('outputs_tables', 'commission_tables'):
+            for dataset in self.dataset_dict[table_type]:
+                dataset_id = self._final_dataset_id(table_type, dataset)
+                self.final_inputs.setdefault(dataset_id, []).append(self.dataset_dict[table_type][dataset]['file'])
+        
+        if not self.incremental:
+            return
+        
+        for dataset_id in self.final_inputs:
+            if self.manifest.is_current(f"{self.output_location}/{dataset_id}.xlsx", self.final_inputs[dataset_id]):
+                self.unchanged.append(dataset_id)
+        
+        for table_type in ('outputs_tables', 'commission_tables'):
+            for dataset in list(self.dataset_dict[table_type]):
+                if self._final_dataset_id(table_type, dataset) in self.unchanged:
+                    del self.dataset_dict[table_type][dataset]
+                    
+        self.commission_tables_count = len(self.dataset_dict['commission_tables'])
+        self.outputs_tables_count = len(self.dataset_dict['outputs_tables'])
+        
+        if self.unchanged != []:
+            print(f"{len(self.unchanged)} final tables unchanged since the last run - {self.unchanged}")
+        return
+    
+    def _validate(self):
+        # only the header of each tidy file is read, final tables with a problem are left out before anything is combined
+        if not self.validate:
+            return
+        commission_tables = self.dataset_dict['commission_tables']
+        outputs_tables = self.dataset_dict['outputs_tables']
+        
+        validation = validate_tables(self.validation_report)
+        with self.profile.phase('validation'):
+            validation.column_alignment(
+                    validation.tidy_file_columns({dataset: commission_tables[dataset]['file'] for dataset in commission_tables if commission_tables[dataset]['to_combine']}), 
+                    validation.tidy_file_columns({dataset: outputs_tables[dataset]['file'] for dataset in outputs_tables})
+                    )
+        problems = validation.finish()
+        
+        # a problem with any table going into a final table leaves out the whole final table
+        for table_type in ('outputs_tables', 'commission_tables'):
+            for dataset in self.dataset_dict[table_type]:
+                dataset_id = self._final_dataset_id(table_type, dataset)
+                if dataset in problems and dataset_id not in self.validation_failed:
+                    self.validation_failed.append(dataset_id)
+        
+        for table_type in ('outputs_tables', 'commission_tables'):
+            for dataset in list(self.dataset_dict[table_type]):
+                if self._final_dataset_id(table_type, dataset) in self.validation_failed:
+                    del self.dataset_dict[table_type][dataset]
+                    
+        self.commission_tables_count = len(self.dataset_dict['commission_tables'])
+        self.outputs_tables_count = len(self.dataset_dict['outputs_tables'])
         return
     
     def _create_dataset_dict(self):
@@ -73,171 +169,245 @@ class combine_and_add_metadata():
             
     def _combine_outputs_tables(self):
         print("\nCombining outputs tables")
-        count = 1
+        groups = self._group_outputs_tables(self.dataset_dict['outputs_tables'])
         
-        for file in self.dataset_dict['outputs_tables']:
-            print(f"\n**{file}** - {count} of {self.outputs_tables_count}")
-            
-            if self.dataset_dict['outputs_tables'][file]['has_been_combined'] == True:
-                print(f"{file} has already been combined")
-                count += 1
-                continue
+        if self.number_of_workers > 1 and len(groups) > 1:
+            self._combine_outputs_tables_in_parallel(groups)
             
-            dataset_id = self.dataset_dict['outputs_tables'][file]['dataset_id']
-            
-            # find any other files with same dataset_id
-            combine_with_list = [file]
-            self.dataset_dict['outputs_tables'][file]['has_been_combined'] = True
-            
-            for other_file in self.dataset_dict['outputs_tables']:
-                if other_file == file:
-                    continue
-                
-                other_dataset_id = self.dataset_dict['outputs_tables'][other_file]['dataset_id']
-                if other_dataset_id == dataset_id:
-                    combine_with_list.append(other_file)
-                    self.dataset_dict['outputs_tables'][other_file]['has_been_combined'] = True
-                  
-            # copy files that dont need combining
-            if len(combine_with_list) == 1:
-                file_path = self.dataset_dict['outputs_tables'][file]['file']
-                new_file_path = f"{self.output_location}/{self.dataset_dict['outputs_tables'][file]['dataset_id']}.xlsx"
-                if os.path.exists(new_file_path):
-                    os.remove(new_file_path)
-                    
-                shutil.copyfile(file_path, new_file_path)
-                self.dataset_dict['final'][dataset_id] = {
-                    'file': new_file_path,
-                    'combined': []
-                    }
-                print(f"Outputs table {file} is not combining with another outputs table")
+        else:
+            jobs = [(dataset_id,) + self._outputs_group_job(dataset_id, groups[dataset_id]) for dataset_id in groups]
+            count = 1
+            for (dataset_id, tables_to_combine, output_file), frames in prefetch(jobs, self._read_outputs_group, self.prefetch_tables):
+                print(f"\n**{dataset_id}** - {count} of {len(groups)}")
+                with self.profile.phase('combine', dataset_id):
+                    _combine_outputs_group(tables_to_combine, output_file, self.memory_budget_mb, frames.result())
+                self._record_outputs_group(dataset_id, groups[dataset_id])
                 count += 1
-                continue
-            
-            # combining files
-            print(f"sending outputs tables to combine - {combine_with_list}")
-            self._combine_list_of_outputs_tables(combine_with_list)
-            count += 1
           
         self.length_of_combined_outputs_tables = len(self.dataset_dict['final'])
         return
     
-    def _combine_list_of_outputs_tables(self, list_of_tables):
-        # combines a list of tables and writes it
-        
-        dataset_id = list_of_tables[0].split('_')[-1]
-        output_file = f"{self.output_location}/{dataset_id}.xlsx"
-        
-        # quick check
-        for i in range(1, len(list_of_tables)):
-            assert list_of_tables[i].split('_')[-1] == dataset_id, f"trying to combine outputs tables with different dataset_ids - {dataset_id} & {list_of_tables[i].split('_')[-1]}"
-          
-        # orders tables from nat -> msoa -> ltla
-        df_list = []
-        combined_list_in_order = []
-        if f"nat_{dataset_id}" in list_of_tables:
-            dataset_file = self.dataset_dict['outputs_tables'][f"nat_{dataset_id}"]['file']
-            xlsx = pd.ExcelFile(dataset_file)
-            df_loop = pd.read_excel(xlsx, dtype=str)
-            df_list.append(df_loop)
-            combined_list_in_order.append(f"nat_{dataset_id}")
-        
-        if f"ltla_{dataset_id}" in list_of_tables:
-            dataset_file = self.dataset_dict['outputs_tables'][f"ltla_{dataset_id}"]['file']
-            xlsx = pd.ExcelFile(dataset_file)
-            df_loop = pd.read_excel(xlsx, dtype=str)
-            df_list.append(df_loop)
-            combined_list_in_order.append(f"ltla_{dataset_id}")
-            
-        if f"msoa_{dataset_id}" in list_of_tables:
-            dataset_file = self.dataset_dict['outputs_tables'][f"msoa_{dataset_id}"]['file']
-            xlsx = pd.ExcelFile(dataset_file)
-            df_loop = pd.read_excel(xlsx, dtype=str)
-            df_list.append(df_loop)
-            combined_list_in_order.append(f"msoa_{dataset_id}")
-            
-        df = pd.concat(df_list)
-        df = self._df_column_tidy(df)
-        
-        # delete if exists
-        self._delete(output_file)
-        
-        # write file
-        with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Data', index=False, header=False)
+    def _combine_outputs_tables_in_parallel(self, groups):
+        # each dataset_id is read, combined & written by its own worker
+        # results are folded into dataset_dict['final'] in group order so the outcome does not depend on which worker finishes first
+        # profiled as one combine phase, the tables are combined in the workers
+        print(f"Combining {len(groups)} outputs tables across {self.number_of_workers} workers")
+        with self.profile.phase('combine'), ProcessPoolExecutor(max_workers=self.number_of_workers) as executor:
+            futures = {}
+            for dataset_id in groups:
+                tables_to_combine, output_file = self._outputs_group_job(dataset_id, groups[dataset_id])
+                futures[dataset_id] = executor.submit(_combine_outputs_group, tables_to_combine, output_file, self.memory_budget_mb)
+                
+            count = 1
+            for dataset_id in groups:
+                futures[dataset_id].result()
+                print(f"\n**{dataset_id}** - {count} of {len(groups)}")
+                self._record_outputs_group(dataset_id, groups[dataset_id])
+                count += 1
+        return
+    
+    def _group_outputs_tables(self, outputs_tables):
+        # {dataset_id: [msoa_SP101, nat_SP101 ...]} in one pass, groups keep the order their first table was found in
+        groups = {}
+        for dataset in outputs_tables:
+            groups.setdefault(dataset.split('_')[1], []).append(dataset)
+        return groups
+    
+    def _combined_outputs_tables(self, dataset_id, group):
+        # outputs tables that go into a final table, in order, empty if the table is copied as it is
+        if len(group) == 1:
+            return []
+        return self._outputs_tables_in_order(dataset_id, group)
+    
+    def _outputs_group_job(self, dataset_id, group):
+        # (files to combine in order, output file) for one dataset_id
+        combined = self._combined_outputs_tables(dataset_id, group)
+        tables = combined if combined != [] else group
+        files = [self.dataset_dict['outputs_tables'][table]['file'] for table in tables]
+        return files, f"{self.output_location}/{dataset_id}.xlsx"
+    
+    def _read_outputs_group(self, job):
+        # outputs tables of one dataset_id read ahead of _combine_outputs_group
+        # None for a table copied as it is or tables combined in chunks
+        dataset_id, files, output_file = job
+        if len(files) == 1 or self.memory_budget_mb:
+            return None
+        return [read_table(file, compact=True) for file in files]
+    
+    def _record_outputs_group(self, dataset_id, group):
+        combined = self._combined_outputs_tables(dataset_id, group)
+        for table in group:
+            self.dataset_dict['outputs_tables'][table]['has_been_combined'] = True
             
-        print(f"outputs tables combined {combined_list_in_order}")
         self.dataset_dict['final'][dataset_id] = {
-            'file': output_file,
-            'combined': combined_list_in_order
+            'file': f"{self.output_location}/{dataset_id}.xlsx",
+            'combined': combined
             }
+        
+        if combined == []:
+            print(f"Outputs table {group[0]} is not combining with another outputs table")
+        else:
+            print(f"outputs tables combined {combined}")
+        return
+    
+    def _outputs_tables_in_order(self, dataset_id, list_of_tables):
+        # orders tables from nat -> ltla -> msoa
+        tables_in_order = []
+        for area in ('nat', 'ltla', 'msoa'):
+            if f"{area}_{dataset_id}" in list_of_tables:
+                tables_in_order.append(f"{area}_{dataset_id}")
+        return tables_in_order
+    
+    def _check_columns_match(self, df, df_to_combine):
+        assert len(df.columns) == len(df_to_combine.columns), "Column lengths for df & df_to_combine do not match"
+        for i in range(len(df.columns)):
+            assert df.columns[i] == df_to_combine.columns[i], f"df col {df.columns[i]} does not match df_to_combine col {df_to_combine.columns[i]}"
         return
     
+    def combine_frames(self, commission_frames, outputs_frames):
+        # in memory version of _combine_outputs_tables & _combine_commission_and_outputs_tables, used by run_pipeline
+        # frames are tidy DataFrames keyed by dataset (SP101A, msoa_SP101 etc)
+        # commission tables being combined are turned into text first, as if read back from their tidy file,
+        # tables that are not combined keep their types the same as when their tidy file is copied
+        # returns {dataset_id: df} of final tables and fills in self.dataset_dict['final'] ready for _get_metadata
+        self.dataset_dict['final'] = {}
+        final_frames = {}
+        
+        outputs_tables = self._group_outputs_tables(outputs_frames)
+        for dataset_id in outputs_tables:
+            combined_list_in_order = self._combined_outputs_tables(dataset_id, outputs_tables[dataset_id])
+            if combined_list_in_order == []:
+                final_frames[dataset_id] = outputs_frames[outputs_tables[dataset_id][0]]
+            else:
+                final_frames[dataset_id] = concat_tables([outputs_frames[table] for table in combined_list_in_order])
+                print(f"outputs tables combined {combined_list_in_order}")
+                
+            self.dataset_dict['final'][dataset_id] = {
+                'file': f"{self.output_location}/{dataset_id}.xlsx",
+                'combined': combined_list_in_order
+                }
+        self.length_of_combined_outputs_tables = len(final_frames)
+        
+        for dataset in commission_frames:
+            df = commission_frames[dataset]
+            if dataset.startswith('SP1'):
+                df = compact_dtypes(to_text(df))
+                dataset_to_combine = dataset[:-1]
+                if dataset_to_combine not in final_frames:
+                    raise KeyError(f"Trying to combine {dataset} with {dataset_to_combine} but outputs table does not exist")
+                
+                self._check_columns_match(df, final_frames[dataset_to_combine])
+                final_frames[dataset_to_combine] = concat_tables([df, final_frames[dataset_to_combine]])
+                self.dataset_dict['final'][dataset_to_combine]['combined'].append(dataset)
+                print(f"Combining commission table {dataset} with outputs table {dataset_to_combine}")
+                
+            else:
+                final_frames[dataset] = df
+                self.dataset_dict['final'][dataset] = {
+                    'file': f"{self.output_location}/{dataset}.xlsx",
+                    'combined': []
+                    }
+        self.length_of_combined_ct_outputs_tables = len(final_frames)
+        
+        self.outputs_tables_count = len(outputs_frames)
+        self.commission_tables_count = len(commission_frames)
+        return final_frames
+    
     def _combine_commission_and_outputs_tables(self):
         # combine commission tables with outputs tables
         print("\nCombining commission tables with outputs tables")
         count = 1
         
-        for dataset in self.dataset_dict['commission_tables']:
+        # two commission tables combined with the same final table can not read it ahead, the first one changes it
+        final_tables = [table['combine_with'] for table in self.dataset_dict['commission_tables'].values() if table['to_combine']]
+        self.shared_final_tables = {dataset_id for dataset_id in final_tables if final_tables.count(dataset_id) > 1}
+        
+        datasets = list(self.dataset_dict['commission_tables'])
+        for dataset, tables in prefetch(datasets, self._read_commission_table, self.prefetch_tables):
             print(f"\n**{dataset}** - {count} of {self.commission_tables_count}")
-            
-            if self.dataset_dict['commission_tables'][dataset]['to_combine']:
-                dataset_file = self.dataset_dict['commission_tables'][dataset]['file']
-                xlsx = pd.ExcelFile(dataset_file)
-                df = pd.read_excel(xlsx, dtype=str)
+            with self.profile.phase('combine', dataset) as record:
+                if self.dataset_dict['commission_tables'][dataset]['to_combine']:
+                    dataset_file = self.dataset_dict['commission_tables'][dataset]['file']
                 
-                dataset_to_combine = self.dataset_dict['commission_tables'][dataset]['combine_with']
-                dataset_file_to_combine = f"{self.output_location}/{dataset_to_combine}.xlsx"
-                if not os.path.exists(dataset_file_to_combine):
-                    raise FileNotFoundError(f"Trying to combine {dataset} with {dataset_to_combine} but file does not exist - {dataset_file_to_combine}")
+                    dataset_to_combine = self.dataset_dict['commission_tables'][dataset]['combine_with']
+                    dataset_file_to_combine = f"{self.output_location}/{dataset_to_combine}.xlsx"
+                    if not os.path.exists(dataset_file_to_combine):
+                        raise FileNotFoundError(f"Trying to combine {dataset} with {dataset_to_combine} but file does not exist - {dataset_file_to_combine}")
                 
-                xlsx_to_combine = pd.ExcelFile(dataset_file_to_combine)
-                df_to_combine = pd.read_excel(xlsx_to_combine, dtype=str)
+                    if self.memory_budget_mb:
+                        print(f"Combining commission table {dataset} with outputs table {dataset_to_combine}")
+                        write_chunks(dataset_file_to_combine, count_rows(self._combined_chunks(dataset_file, dataset_file_to_combine), record, 'rows_out'))
+                        self.dataset_dict['final'][dataset_to_combine]['combined'].append(dataset)
+                        count += 1
+                        continue
                 
-                assert len(df.columns) == len(df_to_combine.columns), "Column lengths for df & df_to_combine do not match"
-                for i in range(len(df.columns)):
-                    assert df.columns[i] == df_to_combine.columns[i], f"df col {df.columns[i]} does not match df_to_combine col {df_to_combine.columns[i]}"
-                    
-                # combining the df's
-                new_df = pd.concat([df, df_to_combine])
-                new_df = self._df_column_tidy(new_df)
+                    df, df_to_combine = tables.result()
+                    if df_to_combine is None:
+                        df_to_combine = read_table(dataset_file_to_combine, compact=True)
+                    record['rows_in'] = len(df) + len(df_to_combine)
                 
-                print(f"Combining commission table {dataset} with outputs table {dataset_to_combine}")
+                    self._check_columns_match(df, df_to_combine)
                 
-                # delete if exists
-                self._delete(dataset_file_to_combine)
+                    # combining the df's
+                    new_df = concat_tables([df, df_to_combine])
+                    record['rows_out'] = len(new_df)
                 
-                # write to dataset_file_to_combine
-                with pd.ExcelWriter(dataset_file_to_combine, engine='openpyxl') as writer:
-                    new_df.to_excel(writer, sheet_name='Data', index=False, header=False)
+                    print(f"Combining commission table {dataset} with outputs table {dataset_to_combine}")
+                
+                    # delete if exists
+                    self._delete(dataset_file_to_combine)
+                
+                    # write to dataset_file_to_combine
+                    write_table(new_df, dataset_file_to_combine)
                     
-                self.dataset_dict['final'][dataset_to_combine]['combined'].append(dataset)
+                    self.dataset_dict['final'][dataset_to_combine]['combined'].append(dataset)
                 
-            else:
-                # write files that are not being combined
-                file_path = self.dataset_dict['commission_tables'][dataset]['file']
-                new_file_path = f"{self.output_location}/{dataset}.xlsx"
-                shutil.copyfile(file_path, new_file_path)
+                else:
+                    # write files that are not being combined
+                    file_path = self.dataset_dict['commission_tables'][dataset]['file']
+                    new_file_path = f"{self.output_location}/{dataset}.xlsx"
+                    self._copy_to_final(file_path, new_file_path)
                 
-                print(f"Commission table {dataset} not combining with any output tables")
+                    print(f"Commission table {dataset} not combining with any output tables")
                 
-                self.dataset_dict['final'][dataset] = {
-                    'file': new_file_path,
-                    'combined': []
-                    }
+                    self.dataset_dict['final'][dataset] = {
+                        'file': new_file_path,
+                        'combined': []
+                        }
             
             count += 1
             
         self.length_of_combined_ct_outputs_tables = len(self.dataset_dict['final'])
         return
     
-    def _df_column_tidy(self, dataframe):
-        # putting column names in df to avoid bold headers in excel
-        dataframe = dataframe.reset_index(drop=True)
-        dataframe.index = dataframe.index+1  
-        dataframe.loc[0] = dataframe.columns
-        dataframe = dataframe.sort_index()
-        return dataframe
+    def _read_commission_table(self, dataset):
+        # (commission table, final table it is combined with) read ahead of _combine_commission_and_outputs_tables
+        # None for tables copied as they are or combined in chunks, the final table is None if it is shared
+        table = self.dataset_dict['commission_tables'][dataset]
+        if not table['to_combine'] or self.memory_budget_mb:
+            return None
+        df = read_table(table['file'], compact=True)
+        if table['combine_with'] in self.shared_final_tables:
+            return df, None
+        return df, read_table(f"{self.output_location}/{table['combine_with']}.xlsx", compact=True)
+    
+    def _combined_chunks(self, dataset_file, dataset_file_to_combine):
+        # the commission table then the final table it is combined with, a chunk at a time
+        first_chunk = None
+        for file in (dataset_file, dataset_file_to_combine):
+            file_chunk = 0
+            for chunk in iter_table(file, self.memory_budget_mb, compact=True):
+                if first_chunk is None:
+                    first_chunk = chunk
+                elif file_chunk == 0:
+                    self._check_columns_match(first_chunk, chunk)
+                file_chunk += 1
+                yield chunk
+        return
+    
+    def _copy_to_final(self, file_path, new_file_path):
+        _copy_to_final(file_path, new_file_path, self.memory_budget_mb)
+        return
     
     def _delete(self, file):
         # delete if exists
@@ -249,102 +419,62 @@ class combine_and_add_metadata():
         # gets all the metadata 
         print("Fetching metadata")
         
-        dataset_df = pd.read_csv(f"{self.cantabular_files_path}/Dataset.csv")
-        commission_metadata_df1 = pd.read_excel(f"{self.commission_tables_metadata}", sheet_name="EILR")
-        commission_metadata_df2 = pd.read_excel(f"{self.commission_tables_metadata}", sheet_name="COB")
-        
         for dataset_id in self.dataset_dict['final']:
             if dataset_id.startswith("SP2") and dataset_id.endswith('H') or dataset_id.startswith("SP2") and dataset_id.endswith('G') or dataset_id in ("SP115A", "SP116A", "SP117A", "SP118A", "SP119A"):
-                df_loop = commission_metadata_df1[commission_metadata_df1[' table number'] == dataset_id]
+                commission_table = self.metadata.commission_table(dataset_id)
                 
                 self.metadata_dict[dataset_id] = {}
-                self.metadata_dict[dataset_id]['dataset_title'] = df_loop['table title'].iloc[0]
-                self.metadata_dict[dataset_id]['dataset_description'] = df_loop['dataset_description / Table Notes'].iloc[0]
+                self.metadata_dict[dataset_id]['dataset_title'] = commission_table['title']
+                self.metadata_dict[dataset_id]['dataset_description'] = commission_table['description']
                 self.metadata_dict[dataset_id]['dataset_statistical_unit'] = "Person"
                 self.metadata_dict[dataset_id]['dataset_population'] = self._get_dataset_population(dataset_id) # TODO - check works against spreadsheets
                 
             
             elif dataset_id.startswith("SP1") or dataset_id.startswith("SP2"):
-                df_loop = dataset_df[dataset_df['Dataset_Mnemonic'] == dataset_id]
-                
-                if len(df_loop) == 0:
-                    self.dataset_dict['final'][dataset_id]['real_id'] = dataset_id[:-1]
-                else:
+                if self.metadata.has_dataset(dataset_id):
                     self.dataset_dict['final'][dataset_id]['real_id'] = dataset_id
+                else:
+                    self.dataset_dict['final'][dataset_id]['real_id'] = dataset_id[:-1]
                     
-                df_loop = dataset_df[dataset_df['Dataset_Mnemonic'] == self.dataset_dict['final'][dataset_id]['real_id']]
+                dataset = self.metadata.dataset(self.dataset_dict['final'][dataset_id]['real_id'])
                 
                 self.metadata_dict[dataset_id] = {}
-                self.metadata_dict[dataset_id]['dataset_title'] = df_loop['Dataset_Title'].iloc[0]
-                self.metadata_dict[dataset_id]['dataset_description'] = df_loop['Dataset_Description'].iloc[0]
-                self.metadata_dict[dataset_id]['dataset_statistical_unit'] = df_loop['Statistical_Unit'].iloc[0] 
-                self.metadata_dict[dataset_id]['dataset_population'] = df_loop['Dataset_Population'].iloc[0]                        
+                self.metadata_dict[dataset_id]['dataset_title'] = dataset['title']
+                self.metadata_dict[dataset_id]['dataset_description'] = dataset['description']
+                self.metadata_dict[dataset_id]['dataset_statistical_unit'] = dataset['statistical_unit']
+                self.metadata_dict[dataset_id]['dataset_population'] = dataset['population']
                     
             else:
                 raise TypeError(f"{dataset_id} should start SP1 or SP2")
         
-        del dataset_df
-        
-        source_df = pd.read_csv(f"{self.cantabular_files_path}/Source.csv")
-        statement = source_df['SDC_Statement'].iloc[0]
-        
         for dataset_id in self.metadata_dict:
-            self.metadata_dict[dataset_id]['source_sdc_statement'] = statement    
-        
-        del source_df, statement
-        
-        dataset_variable_df = pd.read_csv(f"{self.cantabular_files_path}/Dataset_Variable.csv")
+            self.metadata_dict[dataset_id]['source_sdc_statement'] = self.metadata.sdc_statement
         
         for dataset_id in self.metadata_dict:
             if dataset_id.startswith("SP2") and dataset_id.endswith('H') or dataset_id.startswith("SP2") and dataset_id.endswith('G') or dataset_id in ("SP115A", "SP116A", "SP117A", "SP118A", "SP119A"):
                 
-                df_loop = commission_metadata_df1[commission_metadata_df1[' table number'] == dataset_id]
+                commission_table = self.metadata.commission_table(dataset_id)
                 
                 self.metadata_dict[dataset_id]['area_types'] = {}
                 self.metadata_dict[dataset_id]['variables'] = {}
                 
-                variables_list = df_loop['variables'].iloc[0]
-                if variables_list.startswith('Flat classification'):
-                    variables_list = variables_list.split('Flat classification for ethnic group, ')[-1]
-                
-                variables_list = variables_list.split(',')
-                variables_list = [variable.strip().lower() for variable in variables_list]
+                for variable, classification in commission_table['variables'].items():
+                    self.metadata_dict[dataset_id]['variables'][variable] = {}
+                    self.metadata_dict[dataset_id]['variables'][variable]['classification'] = classification
                 
-                for variable in variables_list:
-                    is_correct_variable_name = True
-                    for item in variable:
-                        if item.isnumeric():
-                            is_correct_variable_name = False
-                            
-                    if is_correct_variable_name:
-                        correct_variable_name = variable
-                    else:
-                        correct_variable_name = '_'.join(variable.split('_')[:-1])
-                    
-                    self.metadata_dict[dataset_id]['variables'][correct_variable_name] = {}
-                    self.metadata_dict[dataset_id]['variables'][correct_variable_name]['classification'] = variable
-                    
-                areas_list = df_loop['Geography'].iloc[0]
-                areas_list = areas_list.split('/')
-                lookup = {'national': 'nat', 'country': 'ctry', 'region': 'rgn'}
-                areas_list = [lookup.get(area.lower(), area.lower()) for area in areas_list]
-                
-                for area in areas_list:
+                for area in commission_table['area_types']:
                     self.metadata_dict[dataset_id]['area_types'][area] = {}
             
             elif dataset_id.startswith("SP1") or dataset_id.startswith("SP2"):
             
-                df_loop = dataset_variable_df[dataset_variable_df['Dataset_Mnemonic'] == self.dataset_dict['final'][dataset_id]['real_id']]
-                
                 self.metadata_dict[dataset_id]['area_types'] = {}
                 self.metadata_dict[dataset_id]['variables'] = {}
                 
-                for code in df_loop['Variable_Mnemonic'].unique():
-                    df_loop_2 = df_loop[df_loop['Variable_Mnemonic'] == code]
-                    
-                    if pd.isnull(df_loop_2['Lowest_Geog_Variable_Flag'].iloc[0]):
+                dataset_variables = self.metadata.dataset_variables(self.dataset_dict['final'][dataset_id]['real_id'])
+                for code in dataset_variables:
+                    if pd.isnull(dataset_variables[code]['lowest_geog_flag']):
                         self.metadata_dict[dataset_id]['variables'][code] = {}
-                        self.metadata_dict[dataset_id]['variables'][code]['classification'] = df_loop_2['Classification_Mnemonic'].iloc[0]
+                        self.metadata_dict[dataset_id]['variables'][code]['classification'] = dataset_variables[code]['classification']
                         
                     else:
                         self.metadata_dict[dataset_id]['area_types'][code] = {}
@@ -352,45 +482,32 @@ class combine_and_add_metadata():
                 if self.dataset_dict['final'][dataset_id]['combined'] != []:
                     combined_datasets = self.dataset_dict['final'][dataset_id]['combined']
                     for extra_dataset_id in combined_datasets:
-                        df_loop = commission_metadata_df1[commission_metadata_df1[' table number'] == extra_dataset_id]
-                        if len(df_loop) == 0:
-                            df_loop = commission_metadata_df2[commission_metadata_df2[' table number'] == extra_dataset_id]
-                            
-                        if len(df_loop) == 0:
+                        if not self.metadata.has_commission_table(extra_dataset_id):
                             # means it is looking for outputs table in ct spreadsheet
                             continue
-                        areas_list = df_loop['Geography'].iloc[0]
-                        areas_list = areas_list.split('/')
-                        lookup = {'national': 'nat', 'country': 'ctry', 'region': 'rgn'}
-                        areas_list = [lookup.get(area.lower(), area.lower()) for area in areas_list]
                         
-                        for area in areas_list:
+                        for area in self.metadata.commission_table(extra_dataset_id)['area_types']:
                             self.metadata_dict[dataset_id]['area_types'][area] = {}
-                    
-        
-        del dataset_variable_df, commission_metadata_df1, commission_metadata_df2
-        
-        variable_df = pd.read_csv(f"{self.cantabular_files_path}/Variable.csv")
         
         for dataset_id in self.metadata_dict:
             for area in self.metadata_dict[dataset_id]['area_types']:
-                df_loop = variable_df[variable_df['Variable_Mnemonic'] == area]
+                area_variable = self.metadata.variable(area)
                 
-                self.metadata_dict[dataset_id]['area_types'][area]['title'] = df_loop['Variable_Title'].iloc[0]
-                self.metadata_dict[dataset_id]['area_types'][area]['description'] = df_loop['Variable_Description'].iloc[0]
+                self.metadata_dict[dataset_id]['area_types'][area]['title'] = area_variable['title']
+                self.metadata_dict[dataset_id]['area_types'][area]['description'] = area_variable['description']
                 
             for variable in self.metadata_dict[dataset_id]['variables']:
-                df_loop = variable_df[variable_df['Variable_Mnemonic'] == variable]
+                variable_metadata = self.metadata.variable(variable)
                 
-                self.metadata_dict[dataset_id]['variables'][variable]['title'] = df_loop['Variable_Title'].iloc[0]
-                self.metadata_dict[dataset_id]['variables'][variable]['description'] = df_loop['Variable_Description'].iloc[0]
-                self.metadata_dict[dataset_id]['variables'][variable]['quality_statement'] = df_loop['Quality_Statement_Text'].iloc[0]
-                if df_loop['Quality_Summary_URL'].iloc[0] == '':
+                self.metadata_dict[dataset_id]['variables'][variable]['title'] = variable_metadata['title']
+                self.metadata_dict[dataset_id]['variables'][variable]['description'] = variable_metadata['description']
+                self.metadata_dict[dataset_id]['variables'][variable]['quality_statement'] = variable_metadata['quality_statement']
+                if variable_metadata['quality_statement_url'] == '':
                     continue
-                elif pd.isnull(df_loop['Quality_Summary_URL'].iloc[0]):
+                elif pd.isnull(variable_metadata['quality_statement_url']):
                     continue
                 else:
-                    topic = df_loop['Topic_Mnemonic'].iloc[0]
+                    topic = variable_metadata['topic']
                     if topic == 'DEM':
                         text = 'Read more in our Demography and migration quality information for Census 2021 methodology'
                     elif topic == 'MIG':
@@ -408,23 +525,13 @@ class combine_and_add_metadata():
                     else:
                         raise NotImplementedError(f"{topic} - not included yet")
                     
-                    self.metadata_dict[dataset_id]['variables'][variable]['quality_statement_url'] = f"=HYPERLINK(\"{df_loop['Quality_Summary_URL'].iloc[0]}\", \"{text}\")"
-                
-        del variable_df
-        
-        category_df = pd.read_csv(f"{self.cantabular_files_path}/Category.csv")
-        classification_df = pd.read_csv(f"{self.cantabular_files_path}/Classification.csv")
+                    self.metadata_dict[dataset_id]['variables'][variable]['quality_statement_url'] = f"=HYPERLINK(\"{variable_metadata['quality_statement_url']}\", \"{text}\")"
         
         for dataset_id in self.metadata_dict:
             for variable in self.metadata_dict[dataset_id]['variables']:
                 classification = self.metadata_dict[dataset_id]['variables'][variable]['classification']
-                df_loop = category_df[category_df['Classification_Mnemonic'] == classification]
-                category_dict = dict(zip(df_loop['External_Category_Label_English'], df_loop['Category_Code']))
-                self.metadata_dict[dataset_id]['variables'][variable]['category'] = category_dict
-                df_loop = classification_df[classification_df['Classification_Mnemonic'] == classification]
-                self.metadata_dict[dataset_id]['variables'][variable]['classification_label'] = df_loop['External_Classification_Label_English'].iloc[0]
-                
-        del category_df, classification_df            
+                self.metadata_dict[dataset_id]['variables'][variable]['category'] = self.metadata.category_codes(classification)
+                self.metadata_dict[dataset_id]['variables'][variable]['classification_label'] = self.metadata.classification_label(classification)
             
         return 
     
@@ -518,30 +625,29 @@ their characteristics cannot be identified."""],
         # parses and then adds the metadata for a given dataset to the tidy excel file
         for dataset_id in self.metadata_dict:
             try:
-                # getting parsed metdata
-                rows_of_data = self._parse_metadata(dataset_id)
-                # creating dataframe of metadata
-                df = pd.DataFrame(rows_of_data, columns=['A', 'B'])
+                with self.profile.phase('metadata_attach', dataset_id) as record:
+                    # getting parsed metdata
+                    rows_of_data = self._parse_metadata(dataset_id)
+                    # creating dataframe of metadata
+                    df = pd.DataFrame(rows_of_data, columns=['A', 'B'])
+                    record['rows_out'] = len(df)
+                    
+                    # adding metadata to file as a new sheet, the Data sheet is not read
+                    dataset_file = self.dataset_dict['final'][dataset_id]['file']
+                    add_xlsx_sheet(dataset_file, 'Metadata', df, header=False)
                 
-                # adding metadata to file
-                dataset_file = self.dataset_dict['final'][dataset_id]['file']
-                book = load_workbook(dataset_file)
-                writer = pd.ExcelWriter(dataset_file, engine='openpyxl')
-                writer.book = book
-                df.to_excel(writer, sheet_name='Metadata', header=False, index=False)
-                writer.close()
+                self.manifest.record(dataset_file, self.final_inputs[dataset_id])
                 
                 print(f"Attached metadata for {dataset_id}")
                 
             except Exception as e:
                 print(f"Error in _add_metadata for {dataset_id}")
                 print(e)
+                self.add_metadata_incomplete.append(dataset_id)
         
         return
     
     def _get_dataset_population(self, dataset_id):
-        commission_metadata_df = pd.read_excel(f"{self.commission_tables_metadata}", sheet_name="EILR")
-        
         if dataset_id.endswith('H'): # Caribbean data
             id_to_use = 'SP219H'
         elif dataset_id.endswith('G'):
@@ -551,19 +657,54 @@ their characteristics cannot be identified."""],
         else:
             raise Exception(f"_get_dataset_population - dataset {dataset_id} is trying to find dataset population from spreadsheet rather than model")
         
-        df = commission_metadata_df[commission_metadata_df[' table number'] == id_to_use]
-        assert len(df) == 1
-        value = df['table population'].iloc[0]
-        value = value.split(':')[0].strip()
+        commission_table = self.metadata.commission_table(id_to_use)
+        if commission_table['rows'] != 1:
+            raise ValueError(f"_get_dataset_population - {id_to_use} is in {commission_table['rows']} rows of the commissioned tables spec, should be 1")
+        if commission_table['population'] is None:
+            raise ValueError(f"_get_dataset_population - {id_to_use} has no table population in the commissioned tables spec")
         
-        return value
+        return commission_table['population']
     
     def _print_outcomes(self): 
         print(f"{self.outputs_tables_count} outputs tables combined into {self.length_of_combined_outputs_tables}")
         print(f"{self.commission_tables_count} commission tables & {self.length_of_combined_outputs_tables} combined outputs tables combined into {self.length_of_combined_ct_outputs_tables} final table")
+        print(f"{len(self.unchanged)} final tables unchanged and skipped")
+        if self.validation_failed != []:
+            print(f"{len(self.validation_failed)} final tables failed validation and were not built - {self.validation_failed}")
+        if self.add_metadata_incomplete != []:
+            print(f"{len(self.add_metadata_incomplete)} final tables failed when adding metadata - {self.add_metadata_incomplete}")
         return
 
 
+def _combine_outputs_group(files, output_file, memory_budget_mb=None, frames=None):
+    # reads the outputs tables of one dataset_id and writes them to output_file, a single table is copied as it is
+    # frames - the tables already read, in the order of files
+    # kept at module level so it can be sent to a process pool
+    if os.path.exists(output_file):
+        os.remove(output_file)
+        
+    if len(files) == 1:
+        _copy_to_final(files[0], output_file, memory_budget_mb)
+    elif frames is not None:
+        write_table(concat_tables(frames), output_file)
+    elif memory_budget_mb:
+        write_chunks(output_file, (chunk for file in files for chunk in iter_table(file, memory_budget_mb, compact=True)))
+    else:
+        write_table(concat_tables([read_table(file, compact=True) for file in files]), output_file)
+    return
+
+
+def _copy_to_final(file_path, new_file_path, memory_budget_mb=None):
+    # final tables are always xlsx, tidy data handed over in a columnar format is converted here
+    if file_path.endswith('.xlsx'):
+        shutil.copyfile(file_path, new_file_path)
+    elif memory_budget_mb:
+        write_chunks(new_file_path, iter_table(file_path, memory_budget_mb, as_text=False))
+    else:
+        write_table(read_table(file_path, as_text=False), new_file_path)
+    return
+
+
 if __name__ == '__main__':
     combine = combine_and_add_metadata()
     combine.run()
@@ -0,0 +1,240 @@
+import os
+import pandas as pd
+from ct_tables_transform import run_transforms_commission_tables
+from sp_data_tidy import run_outputs
+from final_transforms import combine_and_add_metadata
+from accessible_data_builder import AccessibleData
+from table_io import intermediate_file, read_table, write_table, remove_if_replaced, sheet_values, replaced_when_written, XlsxStreamWriter
+from stage_profile import StageProfile
+from validation import validate_tables
+
+# runs every stage in one go - CT transform -> CT tidy -> outputs tidy -> combine -> metadata -> accessible formatting
+# tidy DataFrames are handed straight from one stage to the next instead of being written out and read back in
+# each final table is written once, with its Data & Metadata sheets and the accessible formatting already applied
+#
+# file locations & metadata files are taken from the config of each stage script
+
+
+class run_pipeline():
+
+    def __init__(self, transforms_to_run="*"):
+        ##########
+        self.write_intermediates = False # True also writes the tidy commission & outputs tables to the stage output folders
+        self.accessible = True # False writes the final tables without the accessible formatting
+        self.profile_report = None # e.g. "census-outputs/pipeline-profile.json" - writes time, memory & rows of each dataset & phase at the end of a run
+        self.validate = True # checks every table before anything is tidied & leaves out the final tables with problems
+        self.validation_report = None # e.g. "census-outputs/pipeline-validation.json" - writes every problem found by the checks
+        ##########
+
+        self.commission_tables = run_transforms_commission_tables(transforms_to_run=transforms_to_run)
+        self.outputs_tables = run_outputs()
+        self.combine = combine_and_add_metadata()
+
+        # titles for the accessible formatting come from the same metadata as the combine stage
+        self.accessible_data = AccessibleData()
+        self.accessible_data.cantabular_files_path = self.combine.cantabular_files_path
+        self.accessible_data.commission_tables_metadata = self.combine.commission_tables_metadata
+        self.accessible_data.metadata_snapshot = self.combine.metadata_snapshot
+
+        self.output_location = self.combine.output_location
+        
+        # every stage records its phases in the one profile
+        self.profile = StageProfile('pipeline')
+        for stage in (self.commission_tables, self.outputs_tables, self.combine, self.accessible_data):
+            stage.profile = self.profile
+
+        self.transformed_frames = {}
+        self.commission_frames = {}
+        self.outputs_frames = {}
+        self.final_frames = {}
+
+        self.validation_failed = []
+        self.commission_tables_incomplete = []
+        self.outputs_tables_incomplete = []
+        self.final_tables_incomplete = []
+
+    def run(self):
+        self._run_transforms()
+        self._validate()
+        self._commission_tables()
+        self._outputs_tables()
+        self._combine()
+        self._write_final_tables()
+        self._print_outcomes()
+        self.profile.save(self.profile_report)
+        return
+
+    def _run_transforms(self):
+        ct = self.commission_tables
+        ct._run_scripts()
+        with self.profile.phase('metadata'):
+            ct._get_metadata()
+        return
+
+    def _validate(self):
+        # every table is checked before anything is tidied or written, the problems are reported all together
+        # a problem with any table going into a final table leaves out every table of that final table
+        # the transformed commission tables read for the checks are kept to be tidied
+        if not self.validate:
+            return
+        validation = validate_tables(self.validation_report)
+        validation.commission_tables(self.commission_tables, self.transformed_frames)
+        validation.outputs_tables(self.outputs_tables)
+        validation.column_alignment()
+        problems = validation.finish()
+
+        self.validation_failed = sorted(set(_final_dataset_id(dataset) for dataset in problems))
+        return
+
+    def _commission_tables(self):
+        # tidies what the transform scripts wrote
+        ct = self.commission_tables
+
+        count = 1
+        for dataset_id in ct.transform_status:
+            if _final_dataset_id(dataset_id) in self.validation_failed:
+                self.transformed_frames.pop(dataset_id, None)
+                continue
+
+            print(f"Tidying data for {dataset_id} - {count} of {ct.number_of_scripts}")
+            try:
+                transform_file = ct.transform_status[dataset_id]['output_file']
+                with self.profile.phase('tidy', dataset_id) as record:
+                    df = self.transformed_frames.pop(dataset_id, None)
+                    if df is None:
+                        df = read_table(transform_file, compact=True)
+                    record['rows_in'] = len(df)
+                    df = ct._tidy_dataframe(dataset_id, df)
+                    record['rows_out'] = len(df)
+
+                if self.write_intermediates:
+                    tidy_file = intermediate_file(ct.output_location, dataset_id, ct.intermediate_format)
+                    write_table(df, tidy_file)
+                    remove_if_replaced(transform_file, tidy_file)
+                else:
+                    # the untidied transform output is not left where final_transforms would pick it up
+                    os.remove(transform_file)
+
+                self.commission_frames[dataset_id] = df
+
+            except Exception as e:
+                print(f"Error in _commission_tables for {dataset_id}")
+                print(e)
+                self.commission_tables_incomplete.append(dataset_id)
+
+            count += 1
+
+        return
+
+    def _outputs_tables(self):
+        outputs = self.outputs_tables
+
+        count = 1
+        for dataset in outputs.dataset_dict:
+            if _final_dataset_id(dataset) in self.validation_failed:
+                continue
+
+            print(f"Tidying data for {dataset} - {count} of {outputs.number_of_files}")
+            try:
+                # csv is read as str (held in compact dtypes) so no need to convert
+                with self.profile.phase('tidy', dataset) as record:
+                    df = outputs._tidy_dataframe(dataset)
+                    record['rows_in'] = record['rows_out'] = len(df)
+
+                if self.write_intermediates:
+                    write_table(df, outputs.dataset_dict[dataset]['output_file'])
+
+                self.outputs_frames[dataset] = df
+
+            except Exception as e:
+                print(f"Error in _outputs_tables for {dataset}")
+                print(e)
+                self.outputs_tables_incomplete.append(dataset)
+
+            count += 1
+
+        return
+
+    def _combine(self):
+        print("\nCombining tables")
+        with self.profile.phase('combine') as record:
+            record['rows_in'] = sum(len(df) for df in self.commission_frames.values()) + sum(len(df) for df in self.outputs_frames.values())
+            self.final_frames = self.combine.combine_frames(self.commission_frames, self.outputs_frames)
+            record['rows_out'] = sum(len(df) for df in self.final_frames.values())
+        with self.profile.phase('metadata'):
+            self.combine._get_metadata()
+        return
+
+    def _write_final_tables(self):
+        if self.accessible:
+            self.accessible_data._load_dataset_titles()
+
+        count = 1
+        for dataset_id in self.final_frames:
+            print(f"Writing final table {dataset_id} - {count} of {len(self.final_frames)}")
+            try:
+                self._write_final_table(dataset_id)
+
+            except Exception as e:
+                print(f"Error in _write_final_tables for {dataset_id}")
+                print(e)
+                self.final_tables_incomplete.append(dataset_id)
+
+            count += 1
+
+        return
+
+    def _write_final_table(self, dataset_id):
+        # accessible tables are written with their formatting in a single pass, others are streamed to a write-only workbook
+        with self.profile.phase('metadata_attach', dataset_id) as record:
+            metadata_df = pd.DataFrame(self.combine._parse_metadata(dataset_id), columns=['A', 'B'])
+            record['rows_in'] = len(self.final_frames[dataset_id])
+            record['rows_out'] = len(metadata_df)
+
+            if not self.accessible:
+                with replaced_when_written(f"{self.output_location}/{dataset_id}.xlsx") as temp_file, XlsxStreamWriter(temp_file) as writer:
+                    writer.write_frame('Data', self.final_frames[dataset_id])
+                    writer.write_frame('Metadata', metadata_df, header=False)
+                return
+
+        with self.profile.phase('accessible_formatting', dataset_id):
+            self.accessible_data.write_accessible_workbook(
+                    f"{self.output_location}/{dataset_id}.xlsx", 
+                    dataset_id, 
+                    sheet_values(self.final_frames[dataset_id]), 
+                    sheet_values(metadata_df).values.tolist()
+                    )
+        return
+
+    def _print_outcomes(self):
+        if self.validation_failed != []:
+            print("Final tables that failed validation and were not built")
+            print(self.validation_failed, '\n')
+
+        for stage, incomplete in (
+                ('_commission_tables', self.commission_tables_incomplete),
+                ('_outputs_tables', self.outputs_tables_incomplete),
+                ('_write_final_tables', self.final_tables_incomplete)
+                ):
+            if incomplete != []:
+                print(f"{stage} that errored")
+                print(incomplete, '\n')
+
+        print(f"{len(self.final_frames) - len(self.final_tables_incomplete)} final tables written to {self.output_location}")
+        return
+
+
+def _final_dataset_id(dataset):
+    # the final table a commission (SPxxxA) or outputs (msoa_SPxxx) table ends up in
+    if '_' in dataset:
+        return dataset.split('_')[-1]
+    if dataset.startswith('SP1'):
+        return dataset[:-1]
+    return dataset
+
+
+if __name__ == '__main__':
+    pipeline = run_pipeline(
+            transforms_to_run=['*']
+            )
+    pipeline.run()
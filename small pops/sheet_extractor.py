@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+from table_io import read_xlsx_sheets
+
+# pulls the observations out of a commission table tab in one pass, used by the census-transforms scripts
+# in place of walking each geography with databaker
+#
+# a tab holds one block per small population group - the group sits in column A on the first row of its block
+# and the block runs until the next group in column A or the "Created on" footer
+# dimension columns are either filled down within a block (CLOSEST_ABOVE) or read from the same row (DIRECTLY_LEFT)
+
+CLOSEST_ABOVE = 'closest above'
+DIRECTLY_LEFT = 'directly left'
+
+
+def read_tabs(file):
+    # {tab name: DataFrame of cell values}, see table_io.read_xlsx_sheets
+    return read_xlsx_sheets(file)
+
+
+def column_index(column_letter):
+    # 'A' -> 0, 'AA' -> 26
+    index = 0
+    for letter in column_letter.upper():
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def extract_tab(tab, start_point_row_number, obs_column, area_type, dimensions=()):
+    # tab - DataFrame of cell values with no header, row 0 is excel row 1
+    # dimensions - [(column letter, dimension label, CLOSEST_ABOVE or DIRECTLY_LEFT)]
+    # returns (df, obs_count) - df has the same OBS, small_population, area_type & dimension columns as
+    # ConversionSegment(...).topandas(), obs_count is every non-blank cell in obs_column below start_point_row_number
+    # start_point_row_number is the header row (or the row above the data) as with fill(DOWN), so it is not included
+    start = int(start_point_row_number)
+    values = tab.to_numpy(dtype=object)
+
+    # make sure every column referred to exists
+    number_of_columns = max([column_index(obs_column)] + [column_index(column) for column, label, lookup in dimensions]) + 1
+    if values.shape[1] < number_of_columns:
+        values = np.hstack([values, np.full((values.shape[0], number_of_columns - values.shape[1]), '', dtype=object)])
+
+    blank = _is_blank(values)
+
+    # everything from the first "Created on" in column A down is footer
+    footer = [i for i, value in enumerate(values[:, 0]) if isinstance(value, str) and 'Created on' in value]
+    end = footer[0] if footer else len(values)
+
+    obs_position = column_index(obs_column)
+    obs_count = int((~blank[start:, obs_position]).sum())
+
+    rows = np.arange(len(values))
+    in_data = (rows >= start) & (rows < end)
+
+    # every non-blank cell in column A starts a new block, rows before the first block are ignored
+    is_geog = in_data & ~blank[:, 0]
+    block = np.cumsum(is_geog)
+    in_block = in_data & (block > 0)
+
+    geography = pd.Series(np.where(is_geog, values[:, 0], None), dtype=object)
+    geography = geography.where(in_block).groupby(block).ffill()
+
+    is_obs = in_block & ~blank[:, obs_position]
+
+    df = pd.DataFrame({
+            'OBS': values[is_obs, obs_position],
+            'small_population': geography[is_obs].to_numpy(),
+            'area_type': area_type
+            })
+
+    for column, label, lookup in dimensions:
+        position = column_index(column)
+        dimension = pd.Series(np.where(blank[:, position], None, values[:, position]), dtype=object)
+        if lookup == CLOSEST_ABOVE:
+            dimension = dimension.where(in_block).groupby(block).ffill()
+        elif lookup != DIRECTLY_LEFT:
+            raise ValueError(f"dimension lookup should be {CLOSEST_ABOVE} or {DIRECTLY_LEFT} not {lookup}")
+        df[label] = dimension[is_obs].to_numpy()
+
+    return df, obs_count
+
+
+def _is_blank(values):
+    # empty cells and cells that are only whitespace
+    frame = pd.DataFrame(values)
+    whitespace = frame.apply(lambda column: column.astype(str).str.strip() == '')
+    return frame.isna().to_numpy() | whitespace.to_numpy()
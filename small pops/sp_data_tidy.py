@@ -1,6 +1,13 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from openpyxl import load_workbook
+from cantabular_metadata import get_cantabular_metadata
+from table_io import intermediate_file, iter_table, iter_csv, write_chunks, compact_dtypes
+from build_manifest import BuildManifest, code_version
+from stage_profile import StageProfile, count_rows
+from validation import validate_tables
+import table_io, cantabular_metadata
 
 class run_outputs():
     
@@ -9,6 +16,16 @@ class run_outputs():
         self.location_of_source_files = "sp-data/outputs" 
         self.output_location = "census-test-outputs/outputs" 
         self.cantabular_files_path = "" # to be filled
+        self.commission_tables_metadata = "sp-data/commissioned tables small pops spec 09062023.xlsx"
+        self.metadata_snapshot = "sp-data/metadata-snapshot.pickle"
+        self.intermediate_format = "xlsx" # "parquet" or "arrow" hands tidy data to final_transforms in a columnar format (needs pyarrow)
+        self.incremental = True # skips outputs tables whose csv, metadata & code are unchanged since the last run
+        self.memory_budget_mb = None # e.g. 512 - csvs are tidied in chunks of rows that fit the budget (per worker)
+        self.chunk_rows = 100000 # rows of a csv tidied at a time when there is no memory_budget_mb
+        self.number_of_workers = 1 # more than 1 tidies the csvs in a process pool
+        self.profile_report = None # e.g. "census-test-outputs/outputs-profile.json" - writes time, memory & rows of each dataset at the end of a run
+        self.validate = True # checks the header & counts of every csv before any is tidied & leaves out those with problems
+        self.validation_report = None # e.g. "census-test-outputs/outputs-validation.json" - writes every problem found by the checks
         ##########
         
         if self.output_location == "/":
@@ -18,54 +35,131 @@ class run_outputs():
         self._get_area_metadata()
         self._create_dict()
         
+        self.validation_failed = []
         self.tidy_data_incomplete = []
         self.number_of_files = len(self.source_files) 
         
+        self.manifest = BuildManifest(
+                f"{self.output_location}/.manifest.json", 
+                code_version(__file__, table_io.__file__, cantabular_metadata.__file__), 
+                self.metadata.version
+                )
+        self.unchanged = []
+        self.to_tidy = list(self.dataset_dict)
+        self.profile = StageProfile('outputs')
+        
     def run(self):
+        self._find_unchanged()
+        self._validate()
         self._tidy_data()
+        self.manifest.save()
         self._print_outcomes()
+        self.profile.save(self.profile_report)
         return
     
-    def _tidy_data(self):
+    def _find_unchanged(self):
+        # csvs whose tidy output was built from the same csv are not tidied again
+        self.to_tidy = []
         for dataset in self.dataset_dict:
-            count = 1
-            print(f"Tidying data for {dataset} - {count} of {self.number_of_files}")
+            source_file = self.dataset_dict[dataset]['source_file']
+            output_file = self.dataset_dict[dataset]['output_file']
+            if self.incremental and self.manifest.is_current(output_file, [source_file]):
+                self.unchanged.append(dataset)
+                continue
+            self.to_tidy.append(dataset)
+        return
+    
+    def _validate(self):
+        # every csv is checked before any is tidied, problems are reported all together
+        # csvs with problems are not tidied
+        if not self.validate:
+            return
+        validation = validate_tables(self.validation_report)
+        validation.outputs_tables(self, self.to_tidy)
+        self.validation_failed = validation.finish()
+        return
+    
+    def _tidy_data(self):
+        # each csv is read in chunks without its Percentage column, tidied & written a chunk at a time
+        to_tidy = [dataset for dataset in self.to_tidy if dataset not in self.validation_failed]
+        
+        if self.number_of_workers > 1 and len(to_tidy) > 1:
+            self._tidy_data_in_parallel(to_tidy)
+            return
+        
+        count = 1
+        for dataset in to_tidy:
+            print(f"Tidying data for {dataset} - {count} of {len(to_tidy)}")
             try:
-                df = pd.read_csv(self.dataset_dict[dataset]['source_file'], dtype=str)
-                if 'Percentage' in df.columns:
-                    df = df.drop(['Percentage'], axis=1)
-                
-                area_lookup = self.metadata_dict['area_type']
-                def area_type_label(value):
-                    return area_lookup[value]
-                
-                df['Geography Code'] = df[df.columns[0]]
-                df['Geography Label'] = df[df.columns[1]]
-                df['Area type'] = area_type_label(self.dataset_dict[dataset]['area_type'])
-                
-                new_codelist_order = ['Geography Code', 'Geography Label', 'Area type']
-                for i in range(2, len(df.columns) - 3):
-                    new_codelist_order.append(df.columns[i])
-                    
-                df = df[new_codelist_order]
-                
-                assert df.columns[-1] == "Count", f"{dataset} - last columns should be 'Count' not {df.columns[-1]}"
-                
-                # putting column names in df to avoid bold headers in excel
-                df = df.reset_index(drop=True)
-                df.index = df.index+1  
-                df.loc[0] = df.columns
-                df = df.sort_index()
-                
-                with pd.ExcelWriter(self.dataset_dict[dataset]['output_file'], engine='openpyxl') as writer:
-                    df.to_excel(writer, sheet_name='Data', index=False, header=False)
-                    
-                print(f"{dataset} - tidy data")
+                with self.profile.phase('tidy', dataset) as record:
+                    record['rows_in'], record['rows_out'] = _tidy_outputs_file(*self._tidy_job(dataset))
+                self._record_tidy_file(dataset)
                 
             except Exception as e:
                 print(f"Error in _tidy_data for {dataset}")
                 print(e)
                 self.tidy_data_incomplete.append(f"{dataset}")
+                
+            count += 1
+        
+        return
+    
+    def _tidy_data_in_parallel(self, to_tidy):
+        # each csv is tidied by its own worker, failures are collected in dataset_dict order
+        # profiled as one tidy phase, the csvs are tidied in the workers
+        print(f"Tidying {len(to_tidy)} outputs tables across {self.number_of_workers} workers")
+        with self.profile.phase('tidy') as record, ProcessPoolExecutor(max_workers=self.number_of_workers) as executor:
+            futures, job_errors = {}, {}
+            for dataset in to_tidy:
+                try:
+                    futures[dataset] = executor.submit(_tidy_outputs_file, *self._tidy_job(dataset))
+                except Exception as e:
+                    job_errors[dataset] = e
+            
+            record['rows_in'] = record['rows_out'] = 0
+            count = 1
+            for dataset in to_tidy:
+                try:
+                    if dataset in job_errors:
+                        raise job_errors[dataset]
+                    rows_in, rows_out = futures[dataset].result()
+                    record['rows_in'] += rows_in
+                    record['rows_out'] += rows_out
+                    print(f"Tidied data for {dataset} - {count} of {len(to_tidy)}")
+                    self._record_tidy_file(dataset)
+                    
+                except Exception as e:
+                    print(f"Error in _tidy_data for {dataset}")
+                    print(e)
+                    self.tidy_data_incomplete.append(f"{dataset}")
+                    
+                count += 1
+        
+        return
+    
+    def _tidy_job(self, dataset):
+        # arguments of _tidy_outputs_file for one csv
+        return (
+                dataset,
+                self.dataset_dict[dataset]['source_file'],
+                self.dataset_dict[dataset]['output_file'],
+                self.metadata_dict['area_type'][self.dataset_dict[dataset]['area_type']],
+                self.memory_budget_mb,
+                self.chunk_rows
+                )
+    
+    def _record_tidy_file(self, dataset):
+        self.manifest.record(self.dataset_dict[dataset]['output_file'], [self.dataset_dict[dataset]['source_file']])
+        print(f"{dataset} - tidy data")
+        return
+    
+    def _tidy_dataframe(self, dataset):
+        # reads the outputs table csv and returns it in the tidy data format, all values as str held in compact dtypes
+        df = compact_dtypes(pd.read_csv(self.dataset_dict[dataset]['source_file'], dtype=str, usecols=_is_tidy_column))
+        return self._tidy_columns(dataset, df)
+    
+    def _tidy_columns(self, dataset, df):
+        return _tidy_columns(dataset, df, self.metadata_dict['area_type'][self.dataset_dict[dataset]['area_type']])
     
     def _create_dict(self):
         self.dataset_dict = {}
@@ -76,29 +170,70 @@ class run_outputs():
                     'source_file': f'{self.location_of_source_files}/{file}',
                     'sp_code': sp_code,
                     'area_type': dataset.split('_')[0],
-                    'output_file': f'{self.output_location}/{dataset}.xlsx'
+                    'output_file': intermediate_file(self.output_location, dataset, self.intermediate_format)
                         }
             
     def _get_area_metadata(self):
         # gets some inital metadata for area types
+        self.metadata = get_cantabular_metadata(self.cantabular_files_path, self.commission_tables_metadata, self.metadata_snapshot)
         self.metadata_dict = {}
-        self.metadata_dict['area_type'] = {}
-        variable_df = pd.read_csv(f"{self.cantabular_files_path}/Variable.csv")
-        df = variable_df[variable_df['Variable_Type_Code'] == 'GEOG']
-        for code in df['Variable_Mnemonic'].unique():
-            df_loop = df[df['Variable_Mnemonic'] == code]
-            self.metadata_dict['area_type'][code] = df_loop['Variable_Title'].iloc[0]
+        self.metadata_dict['area_type'] = self.metadata.area_type.copy()
         return
     
     def _print_outcomes(self):            
+        if self.unchanged != []:
+            print(f"{len(self.unchanged)} outputs tables unchanged since the last run")
+            
+        if self.validation_failed != []:
+            print("Failed validation so not tidied")
+            print(self.validation_failed, '\n')
+            
         if self.tidy_data_incomplete != []:
             print("_tidy_data that errored")
             print(self.tidy_data_incomplete, '\n')
             
-        else:
+        elif self.validation_failed == []:
             print("All outputs tables have been transformed into tidy data")
             
 
+def _is_tidy_column(column):
+    # Percentage is not part of the tidy data, so is left out when a csv is read
+    return column != 'Percentage'
+
+
+def _tidy_columns(dataset, df, area_type):
+    # works on the whole table or a chunk of its rows
+    if 'Percentage' in df.columns:
+        df = df.drop(['Percentage'], axis=1)
+    
+    df['Geography Code'] = df[df.columns[0]]
+    df['Geography Label'] = df[df.columns[1]]
+    df['Area type'] = area_type
+    
+    new_codelist_order = ['Geography Code', 'Geography Label', 'Area type']
+    for i in range(2, len(df.columns) - 3):
+        new_codelist_order.append(df.columns[i])
+        
+    df = df[new_codelist_order]
+    
+    assert df.columns[-1] == "Count", f"{dataset} - last columns should be 'Count' not {df.columns[-1]}"
+    return df
+
+
+def _tidy_outputs_file(dataset, source_file, output_file, area_type, memory_budget_mb=None, chunk_rows=100000):
+    # reads source_file in chunks without its Percentage column and writes each chunk to output_file once tidied
+    # returns (rows read, rows written), kept at module level so it can be sent to a process pool
+    if memory_budget_mb:
+        chunks = iter_table(source_file, memory_budget_mb, compact=True, usecols=_is_tidy_column)
+    else:
+        chunks = iter_csv(source_file, chunk_rows, compact=True, usecols=_is_tidy_column)
+    
+    rows = {}
+    chunks = count_rows(chunks, rows, 'rows_in')
+    write_chunks(output_file, count_rows((_tidy_columns(dataset, chunk, area_type) for chunk in chunks), rows, 'rows_out'))
+    return rows['rows_in'], rows['rows_out']
+
+
 if __name__ == '__main__':
     sp_tidy_data = run_outputs()
     sp_tidy_data.run()
@@ -0,0 +1,113 @@
+import os, json, time, datetime, tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# profiling of a stage run - wall & cpu time, peak memory and rows in & out of each dataset & phase
+# written as a JSON report at the end of the run when the stage has a profile_report file set
+#
+# phases are script_run, metadata, tidy, combine, metadata_attach & accessible_formatting
+# peak_rss_mb is the process's peak memory once the phase has finished, rss_growth_mb how much the phase raised it
+# (not available on windows), work done in worker processes is not included and tables read ahead
+# in prefetch threads count towards whichever phase is running while they are read
+# trace_python_memory also records the peak of python allocations during each phase through tracemalloc,
+# which slows everything down so is off by default
+#
+# phases should not be nested, the tracemalloc peak is reset at the start of each one
+
+REPORT_VERSION = 1
+trace_python_memory = False
+hot_spots = 10 # slowest phases listed at the top of the report
+
+
+class StageProfile():
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.phases = []
+
+        self.started = datetime.datetime.now().isoformat(timespec='seconds')
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+        if trace_python_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def phase(self, phase, dataset=None, rows_in=None):
+        # with profile.phase('tidy', dataset_id) as record:
+        #     record['rows_out'] = len(df)
+        # errors are recorded against the phase and raised again
+        record = {'phase': phase, 'dataset': dataset, 'rows_in': rows_in, 'rows_out': None, 'error': None}
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        rss_before = _peak_rss_mb()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield record
+        except Exception as e:
+            record['error'] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            record['wall_seconds'] = time.perf_counter() - start_wall
+            record['cpu_seconds'] = time.process_time() - start_cpu
+            record['peak_rss_mb'] = _peak_rss_mb()
+            record['rss_growth_mb'] = None if rss_before is None else record['peak_rss_mb'] - rss_before
+            if tracemalloc.is_tracing():
+                record['peak_python_mb'] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            self.phases.append(record)
+
+    def report(self):
+        totals = {}
+        for record in self.phases:
+            total = totals.setdefault(record['phase'], {'count': 0, 'errors': 0, 'wall_seconds': 0, 'cpu_seconds': 0, 'rows_in': 0, 'rows_out': 0})
+            total['count'] += 1
+            total['errors'] += record['error'] is not None
+            for key in ('wall_seconds', 'cpu_seconds', 'rows_in', 'rows_out'):
+                total[key] += record[key] or 0
+
+        return {
+                'version': REPORT_VERSION,
+                'stage': self.stage,
+                'started': self.started,
+                'wall_seconds': time.perf_counter() - self.start_wall,
+                'cpu_seconds': time.process_time() - self.start_cpu,
+                'peak_rss_mb': _peak_rss_mb(),
+                'phase_totals': totals,
+                'hot_spots': sorted(self.phases, key=lambda record: record['wall_seconds'], reverse=True)[:hot_spots],
+                'phases': self.phases
+                }
+
+    def save(self, report_file):
+        # nothing is written if report_file is None
+        if not report_file:
+            return
+        folder = os.path.dirname(report_file)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        temp_file = f"{report_file}.tmp"
+        with open(temp_file, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+        os.replace(temp_file, report_file)
+        print(f"Profile of {self.stage} written to {report_file}")
+        return
+
+
+def count_rows(chunks, record, key):
+    # passes chunks through, adding up their rows in record[key]
+    record[key] = 0
+    for chunk in chunks:
+        record[key] += len(chunk)
+        yield chunk
+    return
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
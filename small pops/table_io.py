@@ -0,0 +1,678 @@
+import os, io, re, shutil, zipfile
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
+import pandas as pd
+from pandas.io.parsers import TextParser
+from openpyxl import Workbook, load_workbook
+
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+
+# reading & writing the tables handed between pipeline stages
+#
+# intermediate_format 'xlsx' keeps the existing hand off files
+# 'parquet' or 'arrow' (arrow ipc / feather) hand off typed columnar files instead and need pyarrow installed
+# the final published tables are always written as xlsx
+#
+# xlsx files are written through XlsxStreamWriter, a write-only workbook that streams rows to disk
+# so memory stays flat however big the table is, the header is written as a plain (not bold) row
+#
+# xlsx files are read by the fastest reader installed - python-calamine (native) if it is,
+# otherwise openpyxl's read-only mode iterating plain cell values rather than cell objects
+# every reader gives the same DataFrame as pd.read_excel, 'pandas' is kept to compare against
+#
+# with a memory budget, iter_table & write_chunks read and write a table in chunks of rows instead of as one DataFrame
+# the first chunk_sample_rows rows are used to estimate how many rows fit in the budget
+# chunked xlsx reads always stream through openpyxl's read-only mode, calamine loads the whole sheet
+#
+# compact=True holds a table read as text in compact dtypes while a stage works on it - label & code columns
+# as categoricals and counts as nullable integers, only where every value can be turned back exactly
+# every write turns compact columns back into the values they were read as (see published), so files are unchanged
+#
+# prefetch reads the next few tables in background threads while the current one is worked on,
+# so the disk is not left idle while a table is combined or written and the other way round
+
+intermediate_formats = ('xlsx', 'parquet', 'arrow')
+xlsx_readers = ('calamine', 'openpyxl', 'pandas')
+chunk_sample_rows = 1000
+chunk_copies = 4 # copies of a chunk alive at once while it is mapped, reordered & written
+count_columns = ('Count', 'OBS')
+
+
+def intermediate_file(location, dataset, intermediate_format):
+    if intermediate_format not in intermediate_formats:
+        raise ValueError(f"intermediate_format should be one of {intermediate_formats} not {intermediate_format}")
+    return f"{location}/{dataset}.{intermediate_format}"
+
+
+def read_table(file, as_text=True, compact=False):
+    # as_text - all values come back as str (or NaN if empty), same as pd.read_excel(..., dtype=str)
+    # otherwise columnar files keep the types they were written with
+    # compact - text is held in compact dtypes, see compact_dtypes
+    if file.endswith('.parquet'):
+        df = pd.read_parquet(file)
+        df = to_text(df) if as_text else df
+
+    elif file.endswith('.arrow'):
+        df = pd.read_feather(file)
+        df = to_text(df) if as_text else df
+
+    else:
+        df = read_xlsx(file, as_text=as_text)
+
+    return compact_dtypes(df) if compact and as_text else df
+
+
+def table_columns(file):
+    # column names of a table file as read_table gives them, without reading its rows
+    if file.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        return list(pq.read_schema(file).names)
+
+    elif file.endswith('.arrow'):
+        import pyarrow as pa
+        with pa.memory_map(file) as source:
+            return list(pa.ipc.open_file(source).schema.names)
+
+    book = load_workbook(file, read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = book.worksheets[0]
+        sheet.reset_dimensions()
+        header = _sheet_data(sheet.iter_rows(max_row=1, values_only=True))
+    finally:
+        book.close()
+    if len(header) == 0:
+        return []
+    return list(TextParser(header, header=0).read().columns)
+
+
+def default_xlsx_reader():
+    if CalamineWorkbook is not None:
+        return 'calamine'
+    return 'openpyxl'
+
+
+def read_xlsx(file, as_text=True, reader=None):
+    # first sheet of file with the first row as the header
+    reader = reader or default_xlsx_reader()
+    if reader == 'pandas':
+        xlsx = pd.ExcelFile(file)
+        if as_text:
+            return pd.read_excel(xlsx, dtype=str)
+        return pd.read_excel(xlsx)
+    
+    rows = list(_read_sheets(file, reader, first_only=True).values())[0]
+    if len(rows) == 0:
+        return pd.DataFrame()
+    # same parser pd.read_excel hands its rows to, so column names, empty values & types come out the same
+    return TextParser(rows, header=0, dtype=str if as_text else None).read()
+
+
+def read_xlsx_sheets(file, reader=None):
+    # every sheet of file as {sheet_name: DataFrame} of raw cell values with no header
+    # row 0 & column 0 are cell A1, empty cells are ''
+    reader = reader or default_xlsx_reader()
+    if reader == 'pandas':
+        sheets = pd.read_excel(file, sheet_name=None, header=None, dtype=object)
+        return {sheet_name: sheets[sheet_name].fillna('') for sheet_name in sheets}
+    
+    sheets = _read_sheets(file, reader)
+    return {sheet_name: pd.DataFrame(sheets[sheet_name], dtype=object) for sheet_name in sheets}
+
+
+def write_table(df, file, sheet_name='Data'):
+    # writes a table to file, the format is picked from the file extension
+    df = published(df)
+    if file.endswith('.parquet'):
+        df.reset_index(drop=True).to_parquet(file, index=False)
+
+    elif file.endswith('.arrow'):
+        df.reset_index(drop=True).to_feather(file)
+
+    else:
+        write_xlsx(file, {sheet_name: df})
+
+    return
+
+
+def iter_table(file, memory_budget_mb, as_text=True, compact=False, usecols=None):
+    # yields file as DataFrames of rows that fit in memory_budget_mb, always at least one even if it is empty
+    # csv files are read with dtype=str when as_text, usecols is passed to pd.read_csv for csv files only
+    if file.endswith('.csv'):
+        pieces = _csv_pieces(file, as_text, usecols)
+    elif file.endswith('.parquet') or file.endswith('.arrow'):
+        pieces = _arrow_pieces(file, as_text)
+    else:
+        pieces = _xlsx_pieces(file, as_text)
+    chunks = _budget_chunks(pieces, memory_budget_mb)
+    if compact and as_text:
+        return (compact_dtypes(chunk) for chunk in chunks)
+    return chunks
+
+
+def iter_csv(file, chunk_rows, as_text=True, compact=False, usecols=None):
+    # yields a csv as DataFrames of chunk_rows rows, always at least one even if it is empty
+    # usecols - as pd.read_csv, columns left out are never parsed
+    chunks = _csv_pieces(file, as_text, usecols, chunk_rows)
+    if compact and as_text:
+        return (compact_dtypes(chunk) for chunk in chunks)
+    return chunks
+
+
+def rows_for_budget(memory_budget_mb, sample):
+    # rows per chunk so a chunk & the copies made of it fit in memory_budget_mb
+    bytes_per_row = sample.memory_usage(deep=True, index=False).sum() / max(len(sample), 1)
+    return max(int(memory_budget_mb * 1024 * 1024 / (max(bytes_per_row, 1) * chunk_copies)), 1)
+
+
+def write_chunks(file, chunks, sheet_name='Data'):
+    # writes an iterable of DataFrames as one table, the format is picked from the file extension
+    # goes through a hidden temporary file so file can also be the one the chunks are read from
+    with replaced_when_written(file) as temp_file, TableWriter(temp_file, sheet_name) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    return
+
+
+@contextmanager
+def replaced_when_written(file):
+    # with replaced_when_written(file) as temp_file: - temp_file is a hidden file next to file
+    # that is moved over file once written, or removed if writing it fails, so file is never left half written
+    folder, name = os.path.split(file)
+    temp_file = os.path.join(folder, f".{name}")
+    try:
+        yield temp_file
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    os.replace(temp_file, file)
+    return
+
+
+class TableWriter():
+    # writes a table a chunk at a time, to xlsx through XlsxStreamWriter or to parquet / arrow through pyarrow
+    # columnar files take their schema from the first chunk, with empty columns stored as strings
+
+    def __init__(self, file, sheet_name='Data'):
+        self.file = file
+        self.sheet_name = sheet_name
+        self.columnar = file.endswith('.parquet') or file.endswith('.arrow')
+        self.writer = None if self.columnar else XlsxStreamWriter(file)
+        self.schema = None
+
+    def write(self, df):
+        if not self.columnar:
+            self.writer.write_frame(self.sheet_name, df)
+            return
+
+        import pyarrow as pa
+        table = pa.Table.from_pandas(published(df).reset_index(drop=True), preserve_index=False)
+        if self.writer is None:
+            self.schema = pa.schema(
+                    [field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in table.schema],
+                    metadata=table.schema.metadata
+                    )
+            if self.file.endswith('.parquet'):
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(self.file, self.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.file, self.schema)
+        self.writer.write_table(table.cast(self.schema))
+        return
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None or self.columnar:
+            self.close()
+        return False
+
+
+def write_xlsx(file, sheets):
+    # sheets - {sheet_name: dataframe}, written in order
+    with XlsxStreamWriter(file) as writer:
+        for sheet_name, df in sheets.items():
+            writer.write_frame(sheet_name, df)
+    return
+
+
+class XlsxStreamWriter():
+    # write-only workbook, each sheet is streamed to disk as rows are added
+    # write_frame can be called more than once for the same sheet to append chunks of a table
+
+    def __init__(self, file):
+        self.file = file
+        self.book = Workbook(write_only=True)
+        self.sheets = {}
+
+    def write_frame(self, sheet_name, df, header=True):
+        # header is only written the first time a sheet is used
+        if sheet_name not in self.sheets:
+            self.sheets[sheet_name] = self.book.create_sheet(sheet_name)
+            if header:
+                self.sheets[sheet_name].append(list(df.columns))
+
+        self.write_rows(sheet_name, _excel_values(df).itertuples(index=False, name=None))
+        return
+
+    def write_rows(self, sheet_name, rows):
+        if sheet_name not in self.sheets:
+            self.sheets[sheet_name] = self.book.create_sheet(sheet_name)
+
+        ws = self.sheets[sheet_name]
+        for row in rows:
+            ws.append(row)
+        return
+
+    def close(self):
+        self.book.save(self.file)
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        return False
+
+
+def add_xlsx_sheet(file, sheet_name, df, header=True):
+    # adds df as a new last sheet of an xlsx file written by openpyxl, without loading the sheets already in it
+    # the sheet is written by pd.DataFrame.to_excel with the header as a plain row of text, cells are not styled
+    # the parts of the workbook are copied as they are into a new zip next to file, with the workbook, relationship
+    # & content type parts edited to list the new sheet, which then replaces file - file is never left half written
+    # the list of sheets in docProps/app.xml is dropped if there is one, excel rebuilds it on save
+    if header:
+        df = pd.concat([pd.DataFrame([list(df.columns)], columns=df.columns, dtype=object), df.astype(object)], ignore_index=True)
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        df.to_excel(writer, sheet_name=sheet_name, header=False, index=False)
+    with zipfile.ZipFile(buffer) as new_book:
+        sheet_xml = new_book.read('xl/worksheets/sheet1.xml').decode('utf-8')
+        shared_strings = new_book.read('xl/sharedStrings.xml').decode('utf-8') if 'xl/sharedStrings.xml' in new_book.namelist() else ''
+    
+    # shared strings & styles are indexes into the parts of the workbook written to buffer, not those of file
+    # so shared strings are written into the cells and styled cells (dates) are not allowed
+    if re.search(r'<c [^>]*\bs="', sheet_xml):
+        raise ValueError(f"{sheet_name} has cells that need a style (e.g. dates) which cannot be added to {file}")
+    strings = [text or '' for text in re.findall(r'<si>(.*?)</si>|<si\s*/>', shared_strings, re.S)]
+    sheet_xml = re.sub(
+        r'<c ([^>]*)t="s"([^>]*)><v>(\d+)</v></c>', 
+        lambda cell: f'<c {cell.group(1)}t="inlineStr"{cell.group(2)}><is>{strings[int(cell.group(3))]}</is></c>', 
+        sheet_xml
+        )
+    
+    with zipfile.ZipFile(file) as book:
+        workbook = book.read('xl/workbook.xml').decode('utf-8')
+        relationships = book.read('xl/_rels/workbook.xml.rels').decode('utf-8')
+        content_types = book.read('[Content_Types].xml').decode('utf-8')
+        
+        if re.search(f'<sheet [^>]*name="{re.escape(_xml_attribute(sheet_name))}"', workbook):
+            raise ValueError(f"{file} already has a sheet called {sheet_name}")
+        
+        sheet_number = 1
+        while f"xl/worksheets/sheet{sheet_number}.xml" in book.namelist():
+            sheet_number += 1
+        sheet_part = f"xl/worksheets/sheet{sheet_number}.xml"
+        sheet_id = max([int(number) for number in re.findall(r'sheetId="(\d+)"', workbook)], default=0) + 1
+        relationship_number = max([int(number) for number in re.findall(r'Id="rId(\d+)"', relationships)], default=0) + 1
+        relationship_id = f"rId{relationship_number}"
+        
+        new_parts = {
+            'xl/workbook.xml': workbook.replace(
+                '</sheets>', 
+                f'<sheet name="{_xml_attribute(sheet_name)}" sheetId="{sheet_id}" state="visible" r:id="{relationship_id}" /></sheets>'
+                ),
+            'xl/_rels/workbook.xml.rels': relationships.replace(
+                '</Relationships>', 
+                f'<Relationship Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="/{sheet_part}" Id="{relationship_id}" /></Relationships>'
+                ),
+            '[Content_Types].xml': content_types.replace(
+                '</Types>', 
+                f'<Override PartName="/{sheet_part}" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml" /></Types>'
+                )
+            }
+        if 'docProps/app.xml' in book.namelist():
+            app = book.read('docProps/app.xml').decode('utf-8')
+            sheet_list = r'<(HeadingPairs|TitlesOfParts)\b.*?</\1>|<(HeadingPairs|TitlesOfParts)\s*/>'
+            if re.search(sheet_list, app, re.S):
+                new_parts['docProps/app.xml'] = re.sub(sheet_list, '', app, flags=re.S)
+        
+    # parts keep their order, the new sheet goes in before the first part that changes to the workbook (after the other sheets)
+    # both zips are closed before the copy replaces file
+    with replaced_when_written(file) as temp_file:
+        with zipfile.ZipFile(file) as book, zipfile.ZipFile(temp_file, 'w', compression=zipfile.ZIP_DEFLATED) as copy:
+            sheet_written = False
+            for info in book.infolist():
+                if info.filename in new_parts and info.filename != 'docProps/app.xml' and not sheet_written:
+                    copy.writestr(sheet_part, sheet_xml)
+                    sheet_written = True
+                    
+                part = zipfile.ZipInfo(info.filename, info.date_time)
+                part.compress_type = info.compress_type
+                part.external_attr = info.external_attr
+                if info.filename in new_parts:
+                    copy.writestr(part, new_parts[info.filename])
+                else:
+                    # streamed so a large sheet is never held in memory
+                    with book.open(info) as source, copy.open(part, 'w') as target:
+                        shutil.copyfileobj(source, target, 1024 * 1024)
+    return
+
+
+def _xml_attribute(value):
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+
+def sheet_values(df):
+    # values as the cells of a worksheet - empty values & empty strings are None
+    df = published(df).astype(object)
+    return df.where(df.notna() & (df != ''), None)
+
+
+def read_xlsx_cells(file):
+    # {sheet_name: rows} of cell values as openpyxl loads them - formulas as their text, empty cells as None
+    # rows run to the last cell written in the sheet and are padded with None to the same width
+    book = load_workbook(file, read_only=True, keep_links=False)
+    try:
+        sheets = {}
+        for sheet in book.worksheets:
+            sheet.reset_dimensions()
+            rows = [list(row) for row in sheet.iter_rows(values_only=True)]
+            while rows and rows[-1] == []:
+                rows.pop()
+            max_width = max([len(row) for row in rows], default=0)
+            sheets[sheet.title] = [row + [None] * (max_width - len(row)) for row in rows]
+    finally:
+        book.close()
+    return sheets
+
+
+def compact_dtypes(df):
+    # label & code columns as categoricals - each distinct value is held once
+    # count columns as nullable integers when every value is a whole number written plainly, so str() gives it back
+    df = df.copy(deep=False)
+    for col in df.columns:
+        if col in count_columns and _whole_numbers(df[col]):
+            df[col] = pd.to_numeric(df[col]).astype('Int64')
+        elif _is_text(df[col]):
+            df[col] = df[col].astype('category')
+    return df
+
+
+def published(df):
+    # compact columns back to the values they were read as - categoricals as their values & integer counts as text
+    # frames without compact columns are returned as they are
+    converted = {}
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            converted[col] = df[col].astype(object)
+        elif isinstance(df[col].dtype, pd.Int64Dtype):
+            converted[col] = df[col].astype('string').astype(object).where(df[col].notna(), None)
+
+    if not converted:
+        return df
+    df = df.copy(deep=False)
+    for col in converted:
+        df[col] = converted[col]
+    return df
+
+
+def concat_tables(frames):
+    # pd.concat that keeps compact columns compact - categories are joined rather than falling back to object
+    # a column that is not compact in every frame is published in all of them first
+    frames = list(frames)
+    if len(frames) < 2:
+        return pd.concat(frames)
+
+    frames = [df.copy(deep=False) for df in frames]
+    for col in frames[0].columns:
+        dtypes = [df[col].dtype for df in frames]
+        if all(isinstance(dtype, pd.CategoricalDtype) for dtype in dtypes):
+            categories = pd.Index(pd.concat([pd.Series(dtype.categories) for dtype in dtypes])).unique()
+            for df in frames:
+                df[col] = df[col].cat.set_categories(categories)
+        elif any(dtype != dtypes[0] for dtype in dtypes):
+            for df in frames:
+                df[col] = published(df[[col]])[col]
+    return pd.concat(frames)
+
+
+def _whole_numbers(column):
+    # text of whole numbers that come back exactly from an integer - a minus sign is allowed, but not '+', '-0',
+    # leading zeros or a decimal point, which would be lost
+    if not _is_text(column):
+        return False
+    values = column.dropna()
+    if not all(isinstance(value, str) for value in values):
+        return False
+    return bool(values.str.fullmatch(r'0|-?[1-9][0-9]*').all())
+
+
+def _is_text(column):
+    # object columns, or str columns in versions of pandas that read text as str
+    return column.dtype == object or isinstance(column.dtype, pd.StringDtype)
+
+
+def remove_if_replaced(old_file, new_file):
+    # a stage writing its output in a different format removes the file it replaced
+    if old_file != new_file and os.path.exists(old_file):
+        os.remove(old_file)
+    return
+
+
+def prefetch(items, load, ahead=2):
+    # yields (item, future) for each item in order, future.result() gives load(item)
+    # loads run in background threads up to ahead items past the one being worked on, so at most
+    # ahead + 1 loaded items are held at once however many items there are
+    # an error loading an item is raised by future.result() when that item is reached
+    # ahead=0 loads each item when it is reached, in the calling thread
+    if not ahead:
+        for item in items:
+            yield item, _loaded(load, item)
+        return
+    
+    executor = ThreadPoolExecutor(max_workers=ahead)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item, executor.submit(load, item)))
+            if len(pending) > ahead:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        # loads not started yet are dropped if the caller stops early
+        for item, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+    return
+
+
+def _loaded(load, item):
+    future = Future()
+    try:
+        future.set_result(load(item))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def _read_sheets(file, reader, first_only=False):
+    # {sheet_name: rows} in workbook order, only the first sheet if first_only
+    if reader == 'calamine':
+        if CalamineWorkbook is None:
+            raise ImportError("reader 'calamine' needs python-calamine installed")
+        return _calamine_sheets(file, first_only)
+    elif reader == 'openpyxl':
+        return _openpyxl_sheets(file, first_only)
+    raise ValueError(f"reader should be one of {xlsx_readers} not {reader}")
+
+
+def _calamine_sheets(file, first_only):
+    book = CalamineWorkbook.from_path(file)
+    sheet_names = book.sheet_names[:1] if first_only else book.sheet_names
+    sheets = {}
+    for sheet_name in sheet_names:
+        sheets[sheet_name] = _sheet_data(book.get_sheet_by_name(sheet_name).to_python(skip_empty_area=False))
+    return sheets
+
+
+def _openpyxl_sheets(file, first_only):
+    book = load_workbook(file, read_only=True, data_only=True, keep_links=False)
+    try:
+        sheets = {}
+        for sheet in (book.worksheets[:1] if first_only else book.worksheets):
+            # files written in write-only mode may not record their dimensions
+            sheet.reset_dimensions()
+            sheets[sheet.title] = _sheet_data(sheet.iter_rows(values_only=True))
+    finally:
+        book.close()
+    return sheets
+
+
+def _sheet_data(rows):
+    # cell values as pd.read_excel sees them - empty cells are '', whole number floats are ints
+    # trailing empty cells & rows are trimmed, then rows are padded to the same width
+    data = []
+    last_row_with_data = -1
+    for row_number, row in enumerate(rows):
+        row = [_cell_value(value) for value in row]
+        while row and row[-1] == '':
+            row.pop()
+        if row:
+            last_row_with_data = row_number
+        data.append(row)
+        
+    data = data[:last_row_with_data + 1]
+    if len(data) > 0:
+        max_width = max(len(row) for row in data)
+        data = [row + [''] * (max_width - len(row)) for row in data]
+    return data
+
+
+def _cell_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _budget_chunks(pieces, memory_budget_mb):
+    # joins small pieces into chunks that fit the budget, the size of a row is taken from the first piece
+    chunk, rows_in_chunk, rows_per_chunk = [], 0, None
+    for piece in pieces:
+        if rows_per_chunk is None:
+            rows_per_chunk = rows_for_budget(memory_budget_mb, piece)
+        chunk.append(piece)
+        rows_in_chunk += len(piece)
+        if rows_in_chunk >= rows_per_chunk:
+            yield pd.concat(chunk) if len(chunk) > 1 else chunk[0]
+            chunk, rows_in_chunk = [], 0
+            
+    if chunk:
+        yield pd.concat(chunk) if len(chunk) > 1 else chunk[0]
+    return
+
+
+def _csv_pieces(file, as_text, usecols=None, rows=chunk_sample_rows):
+    dtype = str if as_text else None
+    empty = True
+    with pd.read_csv(file, dtype=dtype, usecols=usecols, chunksize=rows) as reader:
+        for piece in reader:
+            empty = False
+            yield piece
+    if empty:
+        yield pd.read_csv(file, dtype=dtype, usecols=usecols, nrows=0)
+    return
+
+
+def _arrow_pieces(file, as_text):
+    import pyarrow as pa
+    if file.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(file)
+        schema = parquet_file.schema_arrow
+        batches = parquet_file.iter_batches(batch_size=chunk_sample_rows)
+    else:
+        reader = pa.ipc.open_file(pa.memory_map(file))
+        schema = reader.schema
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+    
+    empty = True
+    for batch in batches:
+        for start in range(0, batch.num_rows, chunk_sample_rows):
+            empty = False
+            df = pa.Table.from_batches([batch.slice(start, chunk_sample_rows)], schema=schema).to_pandas()
+            yield to_text(df) if as_text else df
+    if empty:
+        df = schema.empty_table().to_pandas()
+        yield to_text(df) if as_text else df
+    return
+
+
+def _xlsx_pieces(file, as_text):
+    book = load_workbook(file, read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = book.worksheets[0]
+        sheet.reset_dimensions()
+        rows = sheet.iter_rows(values_only=True)
+        header = list(next(rows, ()))
+        
+        piece, empty = [], True
+        for row in rows:
+            piece.append(row)
+            if len(piece) == chunk_sample_rows:
+                empty = False
+                yield _rows_as_frame(header, piece, as_text)
+                piece = []
+        if piece or empty:
+            yield _rows_as_frame(header, piece, as_text)
+    finally:
+        book.close()
+    return
+
+
+def _rows_as_frame(header, rows, as_text):
+    # the same as read_xlsx for a header row & some of the rows below it
+    data = _sheet_data([header] + rows)
+    if len(data) == 0:
+        return pd.DataFrame()
+    return TextParser(data, header=0, dtype=str if as_text else None).read()
+
+
+def _excel_values(df):
+    # empty values are written as empty strings, the same as pd.DataFrame.to_excel
+    df = published(df).astype(object)
+    return df.where(df.notna(), '')
+
+
+def to_text(df):
+    # values in the form they would be read back from excel with dtype=str
+    df = df.reset_index(drop=True).copy()
+    for col in df.columns:
+        if pd.api.types.is_float_dtype(df[col]):
+            df[col] = df[col].map(_float_as_text)
+        else:
+            df[col] = df[col].map(lambda value: value if pd.isnull(value) else str(value))
+    return df
+
+
+def _float_as_text(value):
+    if pd.isnull(value):
+        return value
+    if value.is_integer():
+        return str(int(value))
+    return str(value)
@@ -0,0 +1,33 @@
+import os, sys
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sheet_extractor import extract_tab, CLOSEST_ABOVE, DIRECTLY_LEFT
+
+
+def _tab(rows):
+    # rows - {excel row number: [cell values from column A]}, other rows are empty
+    width = max(len(cells) for cells in rows.values())
+    return pd.DataFrame([rows.get(number, [None] * width) for number in range(1, max(rows) + 1)])
+
+
+def test_header_on_start_row_is_excluded():
+    tab = _tab({
+            10: [None, 'Sex', 'Age', 'Count'],
+            11: ['E02000001 Area 1', 'Female', '0 to 15', 5],
+            12: [None, 'Male', None, 7],
+            13: ['E02000002 Area 2', 'Female', '16 and over', 1],
+            14: [None, 'Male', None, 'c'],
+            16: ['Created on 1 January 2023', None, None, None],
+            })
+
+    df, obs_count = extract_tab(tab, '10', 'D', 'msoa', [('B', 'sex', DIRECTLY_LEFT), ('C', 'age', CLOSEST_ABOVE)])
+
+    assert obs_count == 4
+    assert len(df) == obs_count
+    assert df['OBS'].tolist() == [5, 7, 1, 'c']
+    assert df['small_population'].tolist() == ['E02000001 Area 1', 'E02000001 Area 1', 'E02000002 Area 2', 'E02000002 Area 2']
+    assert df['sex'].tolist() == ['Female', 'Male', 'Female', 'Male']
+    assert df['age'].tolist() == ['0 to 15', '0 to 15', '16 and over', '16 and over']
+    assert (df['area_type'] == 'msoa').all()
@@ -0,0 +1,41 @@
+import os, types
+import importlib.util
+
+# loads census-transforms/<dataset_id>.py scripts as modules
+# a transform module defines run(source_location, output_location) which returns its output dict
+#
+# compiled code objects are cached by file mtime, on disk through the usual __pycache__ .pyc files
+# and in memory for repeat runs in the same process
+# every call gets a fresh module so transforms can run side by side without sharing globals
+
+_code_cache = {}
+
+def load_transform_code(transform_file):
+    mtime = os.stat(transform_file).st_mtime_ns
+    if transform_file in _code_cache and _code_cache[transform_file][0] == mtime:
+        return _code_cache[transform_file][1]
+
+    spec = importlib.util.spec_from_file_location(_module_name(transform_file), transform_file)
+    code = spec.loader.get_code(spec.name)
+    _code_cache[transform_file] = (mtime, code)
+    return code
+
+
+def defines_run(code):
+    # True if the script defines a top level run function, without executing it
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType) and const.co_name == 'run':
+            return True
+    return False
+
+
+def load_transform(transform_file):
+    code = load_transform_code(transform_file)
+    module = types.ModuleType(_module_name(transform_file))
+    module.__file__ = transform_file
+    exec(code, module.__dict__)
+    return module
+
+
+def _module_name(transform_file):
+    return f"census_transforms.{os.path.basename(transform_file).split('.py')[0]}"
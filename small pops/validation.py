@@ -0,0 +1,272 @@
+import os, json, datetime
+import pandas as pd
+from table_io import read_table, iter_table, table_columns, published
+
+# checks every dataset in one pass before anything is tidied, combined or written
+# and reports every problem found together, instead of stopping at the first one
+#
+# checks
+#   unknown_variable - a column of a transformed commission table whose variable is not in the metadata
+#   unmapped_categories - labels with no category code in the metadata & area types with no name
+#   row_count - rows of a transformed commission table against the observations counted in its source tabs
+#               (the 'obs_count' a transform returns, transforms that do not return one are not checked)
+#   non_numeric_count - Count / OBS values that are not numbers (empty values are allowed)
+#   count_not_last - outputs tables whose last column, once Percentage is dropped, is not Count
+#   column_alignment - tidy columns of a SPxxxA commission table against the SPxxx outputs tables it is combined with
+#   missing_outputs_table - SPxxxA commission tables with no SPxxx outputs table to be combined with
+#   unreadable - tables that could not be read to be checked
+#
+# the stages leave out datasets with problems, the rest carry on
+
+REPORT_VERSION = 1
+examples_shown = 10 # values listed against each problem
+
+
+class ValidationReport():
+
+    def __init__(self):
+        self.problems = []
+        self.datasets_checked = 0
+        self.started = datetime.datetime.now().isoformat(timespec='seconds')
+
+    def add(self, check, dataset, message, values=()):
+        values = [str(value) for value in values]
+        self.problems.append({
+                'check': check,
+                'dataset': dataset,
+                'message': message,
+                'examples': values[:examples_shown],
+                'number_of_values': len(values)
+                })
+        return
+
+    def datasets(self):
+        # datasets with at least one problem, in the order they were found
+        return list(dict.fromkeys(problem['dataset'] for problem in self.problems))
+
+    def report(self):
+        by_check = {}
+        for problem in self.problems:
+            by_check[problem['check']] = by_check.get(problem['check'], 0) + 1
+        return {
+                'version': REPORT_VERSION,
+                'started': self.started,
+                'datasets_checked': self.datasets_checked,
+                'datasets_with_problems': self.datasets(),
+                'problems_by_check': by_check,
+                'problems': self.problems
+                }
+
+    def print_report(self):
+        if self.problems == []:
+            print(f"Validation - no problems found in {self.datasets_checked} tables")
+            return
+
+        print(f"Validation - {len(self.problems)} problems found in {len(self.datasets())} of {self.datasets_checked} tables")
+        for problem in self.problems:
+            examples = f" - {problem['examples']}" if problem['examples'] else ""
+            more = f" (+{problem['number_of_values'] - len(problem['examples'])} more)" if problem['number_of_values'] > len(problem['examples']) else ""
+            print(f"  {problem['dataset']} [{problem['check']}] {problem['message']}{examples}{more}")
+        print()
+        return
+
+    def save(self, report_file):
+        # nothing is written if report_file is None
+        if not report_file:
+            return
+        folder = os.path.dirname(report_file)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        temp_file = f"{report_file}.tmp"
+        with open(temp_file, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+        os.replace(temp_file, report_file)
+        print(f"Validation report written to {report_file}")
+        return
+
+
+class validate_tables():
+    # the checks for each stage, each stage runs the parts it has the tables for
+    #   run_transforms_commission_tables - commission_table for each table as it is read to be tidied
+    #   run_outputs - outputs_tables, before tidying
+    #   combine_and_add_metadata - column_alignment on the headers of the tidy files, before combining
+    #   run_pipeline - all of them before anything is tidied
+
+    def __init__(self, report_file=None):
+        self.report_file = report_file
+        self.report = ValidationReport()
+
+        # tidy columns of the tables checked, {dataset: [columns]}, used by column_alignment
+        self.commission_columns = {}
+        self.outputs_columns = {}
+
+    def commission_tables(self, ct, frames=None):
+        # ct - run_transforms_commission_tables after _run_scripts & _get_metadata
+        # frames - {dataset_id: df}, the transformed tables read are added to it to be tidied without reading them again
+        # without frames each table is read, checked & let go
+        for dataset_id in ct.transform_status:
+            if ct.transform_status[dataset_id].get('unchanged'):
+                continue
+            df = self.commission_table(ct, dataset_id, keep=frames is not None)
+            if df is not None:
+                frames[dataset_id] = df
+        return
+
+    def commission_table(self, ct, dataset_id, keep=False):
+        # checks one transformed table, only the distinct values of each column are checked
+        # returns the table read if keep, otherwise it is let go (and read in chunks if ct has a memory budget)
+        output_file = ct.transform_status[dataset_id]['output_file']
+        self.report.datasets_checked += 1
+        with ct.profile.phase('validation', dataset_id) as record:
+            try:
+                if keep:
+                    df = read_table(output_file, compact=True)
+                    chunks = [df]
+                elif ct.memory_budget_mb:
+                    chunks = iter_table(output_file, ct.memory_budget_mb, compact=True)
+                else:
+                    chunks = [read_table(output_file, compact=True)]
+                columns, rows, values = _distinct_values(chunks, skip=('small_population',))
+            except Exception as e:
+                self.report.add('unreadable', dataset_id, str(e))
+                return None
+            record['rows_in'] = rows
+            self._check_commission_table(ct, dataset_id, columns, rows, values, ct.transform_status[dataset_id].get('obs_count'))
+        return df if keep else None
+
+    def outputs_tables(self, outputs, datasets=None):
+        # outputs - run_outputs, only the csv header & Count column are read
+        datasets = list(outputs.dataset_dict) if datasets is None else datasets
+        for dataset in datasets:
+            self.report.datasets_checked += 1
+            source_file = outputs.dataset_dict[dataset]['source_file']
+            with outputs.profile.phase('validation', dataset) as record:
+                try:
+                    header = list(pd.read_csv(source_file, dtype=str, nrows=0).columns)
+                    counts = pd.read_csv(source_file, dtype=str, usecols=['Count'])['Count'] if 'Count' in header else None
+                except Exception as e:
+                    self.report.add('unreadable', dataset, str(e))
+                    continue
+
+                tidy_columns = ['Geography Code', 'Geography Label', 'Area type'] + [column for column in header[2:] if column != 'Percentage']
+                self.outputs_columns[dataset] = tidy_columns
+                if tidy_columns[-1] != 'Count':
+                    self.report.add('count_not_last', dataset, f"last column should be 'Count' not '{tidy_columns[-1]}'")
+
+                if counts is not None:
+                    record['rows_in'] = len(counts)
+                    self._check_numeric(dataset, 'Count', _unique_values(counts))
+        return
+
+    def column_alignment(self, commission_columns=None, outputs_columns=None):
+        # every SPxxxA commission table against each outputs table ({area}_SPxxx) it is combined with
+        # commission_columns / outputs_columns - {dataset: [tidy columns]}, those collected by the other checks if not given
+        commission_columns = self.commission_columns if commission_columns is None else commission_columns
+        outputs_columns = self.outputs_columns if outputs_columns is None else outputs_columns
+
+        outputs_by_dataset_id = {}
+        for dataset in outputs_columns:
+            outputs_by_dataset_id.setdefault(dataset.split('_')[-1], []).append(dataset)
+
+        for dataset_id in commission_columns:
+            if not dataset_id.startswith('SP1'):
+                continue
+            dataset_to_combine = dataset_id[:-1]
+            if dataset_to_combine not in outputs_by_dataset_id:
+                self.report.add('missing_outputs_table', dataset_id, f"no outputs table for {dataset_to_combine} to combine with")
+                continue
+
+            columns = commission_columns[dataset_id]
+            for outputs_dataset in outputs_by_dataset_id[dataset_to_combine]:
+                columns_to_combine = outputs_columns[outputs_dataset]
+                if columns == columns_to_combine:
+                    continue
+
+                missing = [column for column in columns_to_combine if column not in set(columns)]
+                extra = [column for column in columns if column not in set(columns_to_combine)]
+                if missing or extra:
+                    message = f"columns do not match {outputs_dataset} - missing {missing}, not in {outputs_dataset} {extra}"
+                else:
+                    message = f"columns are in a different order to {outputs_dataset} - {columns_to_combine}"
+                self.report.add('column_alignment', dataset_id, message)
+        return
+
+    def tidy_file_columns(self, files):
+        # {dataset: [columns]} from the header of each tidy file, for column_alignment without reading the tables
+        columns = {}
+        for dataset in files:
+            self.report.datasets_checked += 1
+            try:
+                columns[dataset] = table_columns(files[dataset])
+            except Exception as e:
+                self.report.add('unreadable', dataset, str(e))
+        return columns
+
+    def finish(self):
+        # prints & saves the report, returns the datasets with problems
+        self.report.print_report()
+        self.report.save(self.report_file)
+        return self.report.datasets()
+
+    def _check_commission_table(self, ct, dataset_id, columns, rows, values, obs_count=None):
+        # values - {column: Index of its distinct values}
+        if obs_count is not None and rows != obs_count:
+            self.report.add('row_count', dataset_id, f"{rows} rows does not match {obs_count} observations in the source")
+
+        if 'OBS' in columns:
+            self._check_numeric(dataset_id, 'OBS', values['OBS'])
+
+        area_lookup = ct.metadata_dict['area_type']
+        variables = ct.metadata_dict.get(dataset_id, {}).get('variables', {})
+        all_variables_known = True
+        for col in columns:
+            if col in ('OBS', 'small_population'):
+                continue
+            if col == 'area_type':
+                lookup = area_lookup
+            elif col.split(' ')[0] in variables:
+                lookup = variables[col.split(' ')[0]].get('category', {})
+            else:
+                self.report.add('unknown_variable', dataset_id, f"column '{col}' - variable {col.split(' ')[0]} not in the metadata for {dataset_id}")
+                all_variables_known = False
+                continue
+
+            # empty labels have no code either
+            unmapped = values[col].difference(pd.Index(list(lookup.keys()), dtype=object))
+            if len(unmapped) != 0:
+                self.report.add('unmapped_categories', dataset_id, f"values of '{col}' not found in the metadata", unmapped)
+
+        if all_variables_known:
+            self.commission_columns[dataset_id] = ct._tidy_column_names(dataset_id, columns)
+        return
+
+    def _check_numeric(self, dataset, column, values):
+        # values - Index of the distinct values of column, empty values are allowed
+        values = values[values.notna()]
+        values = values[values.astype(str).str.strip() != '']
+        not_numeric = values[pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').isna().to_numpy()]
+        if len(not_numeric) != 0:
+            self.report.add('non_numeric_count', dataset, f"values of '{column}' that are not numbers", not_numeric)
+        return
+
+
+def _distinct_values(chunks, skip=()):
+    # (columns, rows, {column: Index of distinct values}) of a table read whole or in chunks of rows
+    columns, rows, values = [], 0, {}
+    for chunk in chunks:
+        columns = list(chunk.columns)
+        rows += len(chunk)
+        for col in columns:
+            if col in skip:
+                continue
+            chunk_values = _unique_values(chunk[col])
+            values[col] = values[col].union(chunk_values) if col in values else chunk_values
+    return columns, rows, values
+
+
+def _unique_values(column):
+    # distinct values of a column, empty ones included, as an Index
+    # found before anything is converted, so a categorical is not expanded
+    values = pd.Series(column.unique())
+    values = published(values.to_frame('value'))['value'].astype(object)
+    return pd.Index(values, dtype=object)